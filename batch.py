@@ -0,0 +1,159 @@
+import argparse
+import csv
+import json
+import logging
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from search import FlightSearch, answer_query
+
+logging.basicConfig(encoding="utf-8", level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Engine of the worker processes, inherited from the parent when they are forked
+engine = None
+
+
+def read_queries(queries_file_path) -> tuple:
+    """Read the queries of a csv file with one column per argument or of a file with one
+    json query per line, as dicts for SearchQuery.from_dict plus an optional "id". Queries
+    without id get their line number as id. Lines that can not be read as a query are
+    returned apart as {"id", "error"} responses, so the rest of the batch is still
+    answered"""
+    if not os.path.exists(queries_file_path):
+        logger.error("File {} does not exist".format(queries_file_path))
+        exit(1)
+    queries = []
+    errors = []
+    with open(queries_file_path, "r") as queries_file:
+        if queries_file_path.endswith(".csv"):
+            for number, values in enumerate(csv.DictReader(queries_file), 1):
+                if None in values:
+                    errors.append({"id": number, "error": "More values than columns"})
+                    continue
+                queries.append(
+                    {
+                        key: value
+                        for key, value in values.items()
+                        if value not in ("", None)
+                    }
+                )
+                queries[-1].setdefault("id", number)
+        else:
+            lines = (line for line in queries_file if line.strip())
+            for number, line in enumerate(lines, 1):
+                try:
+                    values = json.loads(line)
+                except ValueError as e:
+                    errors.append({"id": number, "error": "Invalid json: {}".format(e)})
+                    continue
+                if not isinstance(values, dict):
+                    errors.append({"id": number, "error": "Query is not a json object"})
+                    continue
+                values.setdefault("id", number)
+                queries.append(values)
+    return queries, errors
+
+
+def init_worker(worker_engine) -> None:
+    """Set the engine of a worker process that was not forked"""
+    global engine
+    engine = worker_engine
+
+
+def answer(values) -> dict:
+    """Answer one query in a worker process, with an error response if it fails in any
+    way so that it does not stop the batch"""
+    try:
+        return answer_query(engine, values)
+    except Exception as e:
+        logger.exception("Query {} failed".format(values.get("id")))
+        return {"id": values.get("id"), "error": str(e)}
+
+
+def run_batch(search_engine, queries, output, workers=None) -> None:
+    """Answer queries over a pool of worker processes, writing one json response per line
+    to output as soon as each one is ready.
+
+    Where processes are forked the workers share the already loaded and indexed dataset
+    with this process, otherwise it is sent once to every worker."""
+    global engine
+    if "fork" in multiprocessing.get_all_start_methods():
+        engine = search_engine
+        executor = ProcessPoolExecutor(workers, multiprocessing.get_context("fork"))
+    else:
+        executor = ProcessPoolExecutor(
+            workers, initializer=init_worker, initargs=(search_engine,)
+        )
+    with executor:
+        futures = {
+            executor.submit(answer, values): values.get("id") for values in queries
+        }
+        for future in as_completed(futures):
+            try:
+                response = future.result()
+            except Exception as e:
+                logger.error("Query {} failed: {}".format(futures[future], e))
+                response = {"id": futures[future], "error": str(e)}
+            output.write(json.dumps(response) + "\n")
+            output.flush()
+
+
+def write_errors(errors, output) -> None:
+    """Write the error responses of the lines read_queries could not read to output"""
+    for error in errors:
+        logger.warning("Query {}: {}".format(error["id"], error["error"]))
+        output.write(json.dumps(error) + "\n")
+    output.flush()
+
+
+def main(args):
+    """Main function. Load the csv files once and answer all the queries of the batch"""
+    search_engine = FlightSearch.from_csv(args.csv_file_path, args.binary_cache)
+    queries, errors = read_queries(args.queries_file_path)
+    if args.output is None:
+        write_errors(errors, sys.stdout)
+        run_batch(search_engine, queries, sys.stdout, args.workers)
+    else:
+        with open(args.output, "w") as output:
+            write_errors(errors, output)
+            run_batch(search_engine, queries, output, args.workers)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Python weekend entry task batch search. Answers all the queries of a "
+        "file in parallel with the dataset loaded once."
+    )
+    parser.add_argument(
+        "csv_file_path",
+        help="Relative paths or globs of the csv dataset files, read at the same time and merged without duplicate flights",
+        type=str,
+        nargs="+",
+    )
+    parser.add_argument(
+        "queries_file_path",
+        help="Relative path of the queries file, a csv file with one column per argument "
+        "or a file with one json query per line.",
+        type=str,
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        help="Path of the file to write the responses to instead of stdout.",
+        type=str,
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        help="Number of worker processes. If not specified, one per cpu.",
+        type=int,
+    )
+    parser.add_argument(
+        "-B",
+        "--binary-cache",
+        help="Load the dataset from a binary file next to the csv file, which is written again whenever the csv file changes.",
+        action="store_true",
+    )
+    main(parser.parse_args())
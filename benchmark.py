@@ -0,0 +1,391 @@
+import argparse
+import csv
+import json
+import logging
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from helpers import CHUNK_SIZE, FLIGHT_FIELDS, read_csv_file, validate_rows
+from search import FlightSearch, SearchQuery
+
+logging.basicConfig(encoding="utf-8", level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+SCHEDULE_START = datetime(2021, 9, 1)
+PHASES = ("load", "validation", "one_way_search", "round_trip_join", "json_output")
+
+
+def airport_code(number) -> str:
+    """Three letter code of the airport number, AAA for 0, AAB for 1 and so on"""
+    letters = ""
+    for _ in range(3):
+        number, letter = divmod(number, 26)
+        letters = chr(ord("A") + letter) + letters
+    return letters
+
+
+def generate_schedule(
+    csv_file_path, airports=50, flights_per_day=500, days=7, hubs=3, seed=0
+) -> int:
+    """Write a synthetic schedule with the columns of the example datasets and return its
+    number of flights.
+
+    The first hubs airports are hubs, and most flights depart from or arrive at one of
+    them. Every pair of airports has its own flight duration and price level, and the
+    same parameters and seed always write the same file."""
+    random_generator = random.Random(seed)
+    codes = [airport_code(number) for number in range(airports)]
+    routes = {}
+    flights = 0
+    with open(csv_file_path, "w", newline="") as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(FLIGHT_FIELDS)
+        for day in range(days):
+            date = SCHEDULE_START + timedelta(days=day)
+            for _ in range(flights_per_day):
+                origin, destination = random_generator.sample(range(airports), 2)
+                if hubs > 0 and random_generator.random() < 0.7:
+                    hub = random_generator.randrange(min(hubs, airports))
+                    if hub == destination:
+                        origin, destination = destination, origin
+                    elif hub != origin:
+                        if random_generator.random() < 0.5:
+                            origin = hub
+                        else:
+                            destination = hub
+                route = (min(origin, destination), max(origin, destination))
+                if route not in routes:
+                    routes[route] = (
+                        random_generator.randint(45, 600),
+                        random_generator.uniform(0.1, 0.5),
+                    )
+                minutes, price_per_minute = routes[route]
+                departure = date + timedelta(
+                    minutes=random_generator.randrange(5 * 60, 23 * 60)
+                )
+                arrival = departure + timedelta(minutes=minutes)
+                flights += 1
+                writer.writerow(
+                    [
+                        "{}{}".format(codes[origin][:2], flights),
+                        codes[origin],
+                        codes[destination],
+                        departure.isoformat(),
+                        arrival.isoformat(),
+                        "{:.1f}".format(
+                            round(minutes * price_per_minute)
+                            + random_generator.randrange(30)
+                        ),
+                        random_generator.randrange(5, 30),
+                        random_generator.randrange(3),
+                    ]
+                )
+    return flights
+
+
+def measure(function, repeat=1):
+    """Run function repeat times to take its best time, and once more to trace the peak
+    of the memory it allocates, which slows it down. Returns its result, the seconds and
+    the bytes"""
+    seconds = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        if seconds is None or elapsed < seconds:
+            seconds = elapsed
+    tracemalloc.start()
+    try:
+        function()
+        peak_memory = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return result, seconds, peak_memory
+
+
+def phase_report(seconds, peak_memory, count, unit) -> dict:
+    """Json-compatible measurements of one phase that processed count units"""
+    return {
+        "seconds": seconds,
+        "count": count,
+        "throughput": count / seconds if seconds > 0 else None,
+        "unit": unit + "/s",
+        "peak_memory": peak_memory,
+    }
+
+
+def sample_queries(airports, queries, days, stops, seed=0) -> tuple:
+    """Deterministic one way and round trip queries between random pairs of airports,
+    departing the first day and returning two days later"""
+    random_generator = random.Random(seed)
+    codes = [airport_code(number) for number in range(airports)]
+    depart_day = SCHEDULE_START.date().isoformat()
+    return_day = (SCHEDULE_START + timedelta(days=min(2, days - 1))).date().isoformat()
+    one_way = []
+    round_trips = []
+    for _ in range(queries):
+        origin, destination = random_generator.sample(codes, 2)
+        one_way.append(
+            SearchQuery(origin, destination, stops=stops, depart_day=depart_day)
+        )
+        round_trips.append(
+            SearchQuery(
+                origin,
+                destination,
+                round=True,
+                stops=stops,
+                depart_day=depart_day,
+                return_day=return_day,
+            )
+        )
+    return one_way, round_trips
+
+
+def run_benchmark(
+    csv_file_path, airports, days, queries, stops, iterative=False, repeat=1
+) -> dict:
+    """Measure every phase of PHASES over the schedule in csv_file_path, taking the best
+    time of repeat runs"""
+    phases = {}
+    data, seconds, peak_memory = measure(lambda: read_csv_file(csv_file_path), repeat)
+    phases["load"] = phase_report(seconds, peak_memory, len(data), "rows")
+
+    with open(csv_file_path, "r", newline="") as csv_file:
+        reader = csv.reader(csv_file)
+        fieldnames = next(reader)
+        positions = [fieldnames.index(field) for field in FLIGHT_FIELDS]
+        rows = list(reader)
+
+    def validate():
+        for start in range(0, len(rows), CHUNK_SIZE):
+            validate_rows(rows[start : start + CHUNK_SIZE], positions, {})
+
+    _, seconds, peak_memory = measure(validate, repeat)
+    phases["validation"] = phase_report(seconds, peak_memory, len(rows), "rows")
+    del rows
+
+    engine = FlightSearch(data, iterative)
+    one_way, round_trips = sample_queries(airports, queries, days, stops)
+    paths, seconds, peak_memory = measure(
+        lambda: [engine.find_paths(query) for query in one_way], repeat
+    )
+    phases["one_way_search"] = phase_report(
+        seconds, peak_memory, len(one_way), "queries"
+    )
+    phases["one_way_search"]["paths"] = sum(len(found) for found in paths)
+
+    legs = [
+        (engine.find_paths(query), engine.find_paths(query, True))
+        for query in round_trips
+    ]
+    pairs, seconds, peak_memory = measure(
+        lambda: [
+            engine.build_round_trip_paths(query, paths_0, paths_1)
+            for query, (paths_0, paths_1) in zip(round_trips, legs)
+        ],
+        repeat,
+    )
+    phases["round_trip_join"] = phase_report(
+        seconds, peak_memory, sum(len(found) for found in pairs), "pairs"
+    )
+
+    def dump():
+        return [
+            json.dumps(engine.build_combinations(query, found), indent=4)
+            for query, found in zip(one_way + round_trips, paths + pairs)
+        ]
+
+    outputs, seconds, peak_memory = measure(dump, repeat)
+    phases["json_output"] = phase_report(
+        seconds,
+        peak_memory,
+        sum(len(found) for found in paths + pairs),
+        "combinations",
+    )
+    phases["json_output"]["bytes"] = sum(len(output) for output in outputs)
+    return phases
+
+
+def find_regressions(report, baseline, tolerance) -> list:
+    """Phases of report that took more than tolerance times longer than in baseline, as
+    (flights, phase, seconds, baseline seconds)"""
+    baseline_runs = {run["flights"]: run for run in baseline["runs"]}
+    regressions = []
+    for run in report["runs"]:
+        baseline_run = baseline_runs.get(run["flights"])
+        if baseline_run is None:
+            continue
+        for phase in PHASES:
+            seconds = run["phases"][phase]["seconds"]
+            baseline_seconds = baseline_run["phases"][phase]["seconds"]
+            if seconds > baseline_seconds * (1 + tolerance):
+                regressions.append((run["flights"], phase, seconds, baseline_seconds))
+    return regressions
+
+
+def print_report(report) -> None:
+    """Print the measurements of report as a table"""
+    print(
+        "{:>10} {:<16} {:>10} {:>24} {:>10}".format(
+            "flights", "phase", "seconds", "throughput", "peak MiB"
+        )
+    )
+    for run in report["runs"]:
+        for phase in PHASES:
+            measurements = run["phases"][phase]
+            throughput = measurements["throughput"]
+            print(
+                "{:>10} {:<16} {:>10.3f} {:>24} {:>10.1f}".format(
+                    run["flights"],
+                    phase,
+                    measurements["seconds"],
+                    (
+                        "-"
+                        if throughput is None
+                        else "{:.0f} {}".format(throughput, measurements["unit"])
+                    ),
+                    measurements["peak_memory"] / 2**20,
+                )
+            )
+
+
+def main(args):
+    """Main function. Generate a schedule for every scale, measure every phase over it and
+    compare the results with a baseline"""
+    report = {"parameters": vars(args).copy(), "runs": []}
+    if args.keep is not None:
+        os.makedirs(args.keep, exist_ok=True)
+    directory = args.keep or tempfile.mkdtemp()
+    for scale in args.scales:
+        flights_per_day = args.flights_per_day * scale
+        csv_file_path = os.path.join(
+            directory,
+            "schedule_{}_{}_{}_{}.csv".format(
+                args.airports, flights_per_day, args.days, args.hubs
+            ),
+        )
+        flights = generate_schedule(
+            csv_file_path, args.airports, flights_per_day, args.days, args.hubs
+        )
+        logger.info("Measuring {} flights".format(flights))
+        report["runs"].append(
+            {
+                "scale": scale,
+                "flights": flights,
+                "phases": run_benchmark(
+                    csv_file_path,
+                    args.airports,
+                    args.days,
+                    args.queries,
+                    args.stops,
+                    args.iterative,
+                    args.repeat,
+                ),
+            }
+        )
+        if args.keep is None:
+            os.remove(csv_file_path)
+    if args.keep is None:
+        os.rmdir(directory)
+    print_report(report)
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(report, f, indent=4)
+    if args.baseline:
+        if not os.path.exists(args.baseline):
+            logger.error("File {} does not exist".format(args.baseline))
+            exit(1)
+        with open(args.baseline, "r") as f:
+            regressions = find_regressions(report, json.load(f), args.tolerance)
+        for flights, phase, seconds, baseline_seconds in regressions:
+            logger.warning(
+                "Regression in {} with {} flights: {:.3f}s, baseline {:.3f}s".format(
+                    phase, flights, seconds, baseline_seconds
+                )
+            )
+        if regressions:
+            exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Python weekend entry task benchmark. Measures loading, searching and "
+        "output over synthetic schedules of growing size."
+    )
+    parser.add_argument(
+        "-a", "--airports", help="Number of airports.", type=int, default=50
+    )
+    parser.add_argument(
+        "-F",
+        "--flights-per-day",
+        help="Number of flights per day at scale 1.",
+        type=int,
+        default=500,
+    )
+    parser.add_argument(
+        "-d", "--days", help="Number of days of the schedule.", type=int, default=7
+    )
+    parser.add_argument(
+        "-H",
+        "--hubs",
+        help="Number of hub airports most flights depart from or arrive at.",
+        type=int,
+        default=3,
+    )
+    parser.add_argument(
+        "-S",
+        "--scales",
+        help="Factors the flights per day are multiplied by, one schedule each.",
+        type=int,
+        nargs="+",
+        default=[1, 2, 4],
+    )
+    parser.add_argument(
+        "-q",
+        "--queries",
+        help="Number of one way and of round trip queries.",
+        type=int,
+        default=20,
+    )
+    parser.add_argument(
+        "-s", "--stops", help="Maximum number of stops.", type=int, default=1
+    )
+    parser.add_argument(
+        "-r",
+        "--repeat",
+        help="Number of times every phase is timed, keeping the best time.",
+        type=int,
+        default=3,
+    )
+    parser.add_argument(
+        "-I",
+        "--iterative",
+        help="Search with the iterative search instead of the recursive one.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-k",
+        "--keep",
+        help="Directory to keep the generated schedules in.",
+        type=str,
+    )
+    parser.add_argument(
+        "--save-baseline",
+        help="Save the measurements to this json file.",
+        type=str,
+    )
+    parser.add_argument(
+        "--baseline",
+        help="Compare the measurements with a json file saved with --save-baseline, exiting with an error if any phase is slower.",
+        type=str,
+    )
+    parser.add_argument(
+        "--tolerance",
+        help="Fraction a phase can be slower than the baseline before it is flagged.",
+        type=float,
+        default=0.25,
+    )
+    main(parser.parse_args())
@@ -0,0 +1,168 @@
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import replace
+from helpers import datasets_version, read_delta_file, split_airports
+from search import FlightSearch
+
+
+class QueryCache:
+    """Memoise the searches of a FlightSearch engine.
+
+    Up to maxsize results are kept, dropping the least recently used one first. Queries
+    without a limit, a Pareto frontier or a max_price share one entry for any number of
+    bags, with the trips found without bags, which are only filtered by the flights that
+    allow the bags and sorted again for the new prices. If the engine was
+    read from a csv file, the file is reloaded and all the entries dropped as soon as it
+    changes.
+
+    Every entry keeps the codes of the airports its search reached, so changes applied
+    with apply_changes only drop the entries of the searches that reached one of the
+    airports of the changed flights."""
+
+    def __init__(self, engine, maxsize=1024):
+        self.engine = engine
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.updates = ReadWriteLock()
+        self.hits = 0
+        self.misses = 0
+
+    def search(self, query) -> list:
+        """All combinations of flights matching query, sorted by price"""
+        with self.updates.reading():
+            engine = self.current_engine()
+            return engine.build_combinations(query, self.search_paths(engine, query))
+
+    def search_paths(self, engine, query) -> list:
+        """Paths of search, like FlightSearch.search_paths"""
+        normalised = cache_key(query)
+        key = (engine.version, normalised)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+        if entry is not None:
+            paths = entry[0]
+        else:
+            reached = set(split_airports(query.origin))
+            reached.update(split_airports(query.destination))
+            paths = engine.with_reached(reached).search_paths(normalised)
+            with self.lock:
+                if self.maxsize > 0:
+                    self.entries[key] = (paths, reached)
+                    self.entries.move_to_end(key)
+                while len(self.entries) > self.maxsize:
+                    self.entries.popitem(last=False)
+        if normalised.bags != query.bags:
+            paths = engine.allowing_bags(query, paths)
+            if query.round:
+                paths = engine.sort_round_trip_paths(query, paths)
+            else:
+                paths = engine.sort_paths(query, paths)
+        return paths
+
+    def current_engine(self) -> FlightSearch:
+        """Engine with the current dataset, reloading it and dropping all the entries if
+        its csv file changed. If the changed file can not be read, ValueError is raised
+        and the previous dataset is kept until the file changes again"""
+        with self.lock:
+            if self.engine.is_outdated():
+                source = self.engine.source
+                try:
+                    engine = FlightSearch.from_csv(
+                        source, self.engine.binary_cache, self.engine.iterative
+                    )
+                except SystemExit:
+                    # The loader exits after logging why the files are invalid. Keep
+                    # the old dataset until they change again
+                    self.engine.version = datasets_version(source)
+                    self.entries.clear()
+                    raise ValueError(
+                        "Could not reload the flights, the previous ones are used"
+                    ) from None
+                self.engine = engine
+                self.entries.clear()
+            return self.engine
+
+    def apply_changes(self, changes) -> int:
+        """Apply changes as returned by read_delta_file to the dataset of the engine, see
+        FlightSearch.apply_changes, once the searches running are done. Returns the
+        number of entries dropped"""
+        with self.updates.writing():
+            airports = self.current_engine().apply_changes(changes)
+            with self.lock:
+                outdated = [
+                    key
+                    for key, (_, reached) in self.entries.items()
+                    if not reached.isdisjoint(airports)
+                ]
+                for key in outdated:
+                    del self.entries[key]
+        return len(outdated)
+
+    def apply_delta_file(self, delta_file_path) -> tuple:
+        """Apply the changes of a delta file, see read_delta_file. Returns the number of
+        valid changes in it and the number of entries dropped"""
+        changes = read_delta_file(delta_file_path)
+        return len(changes), self.apply_changes(changes)
+
+    def clear(self) -> None:
+        """Drop all the entries"""
+        with self.lock:
+            self.entries.clear()
+
+
+class ReadWriteLock:
+    """Lock that can be held by any number of readers at once or by one writer"""
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.readers = 0
+        self.writer = False
+
+    @contextmanager
+    def reading(self):
+        """Hold the lock as a reader in the with block"""
+        with self.condition:
+            while self.writer:
+                self.condition.wait()
+            self.readers += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.readers -= 1
+                if not self.readers:
+                    self.condition.notify_all()
+
+    @contextmanager
+    def writing(self):
+        """Hold the lock as the only writer in the with block"""
+        with self.condition:
+            while self.writer or self.readers:
+                self.condition.wait()
+            self.writer = True
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.writer = False
+                self.condition.notify_all()
+
+
+def cache_key(query):
+    """Query whose paths include the ones of query that is used to store them. Unless
+    there is a limit, a Pareto frontier or a max_price, which depend on the prices, bags
+    are left out of it"""
+    if (
+        query.limit is None
+        and query.max_price is None
+        and not (query.pareto or query.pareto_stops)
+    ):
+        return replace(query, bags=0)
+    return query
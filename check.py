@@ -0,0 +1,280 @@
+import argparse
+import logging
+import random
+from dataclasses import replace
+from cache import QueryCache
+from dataset import FlightTable, seconds_to_timestamp
+from helpers import expand_paths, read_datasets
+from search import FlightSearch, SearchQuery, pareto_frontier
+
+logging.basicConfig(encoding="utf-8", level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+CHANGE_OPERATIONS = ("append", "update", "delete")
+
+
+def enumerate_paths(engine, query, is_return=False) -> list:
+    """Paths of all trips of query found by trying every flight at every hop, without
+    any of the pruning of the engine, sorted with sort_paths"""
+    data = engine.data
+    origins, destinations = engine.endpoints(query, is_return)
+    if not origins or not destinations:
+        return []
+    paths = []
+
+    def extend(path, airports):
+        row = path[-1]
+        if data.destination[row] in destinations:
+            if (query.stops is None or len(path) <= query.stops + 1) and (
+                query.trip_duration is None
+                or engine.travel_time(path) / 3600 <= query.trip_duration
+            ):
+                paths.append(path)
+            return
+        if query.stops is not None and len(path) > query.stops:
+            return
+        for next_row in data.departing_from(
+            data.destination[row],
+            data.arrival[row] + query.min_layover_time * 3600,
+            data.arrival[row] + query.max_layover_time * 3600,
+        ):
+            airport = data.destination[next_row]
+            if data.bags_allowed[next_row] >= query.bags and airport not in airports:
+                extend(path + (next_row,), airports | {airport})
+
+    # Trips can not fly back to where they started or to the other origins, unless they
+    # are destinations too
+    for row in engine.first_flights(query, origins, is_return):
+        if data.destination[row] not in origins - destinations:
+            extend(
+                (row,),
+                (origins - destinations) | {data.origin[row], data.destination[row]},
+            )
+    return engine.sort_paths(query, paths)
+
+
+def enumerate_trips(engine, query) -> list:
+    """Paths, or pairs of paths for round trips, of all trips of query by enumerate_paths
+    and every pair of them, sorted like search_paths and within query.max_price"""
+    if not query.round:
+        trips = enumerate_paths(engine, query)
+        price = lambda path: engine.path_price(query, path)
+    else:
+        min_layover = query.min_layover_time * 3600
+        trips = engine.sort_round_trip_paths(
+            query,
+            [
+                (path_0, path_1)
+                for path_0 in enumerate_paths(engine, query)
+                for path_1 in enumerate_paths(engine, query, True)
+                if engine.data.departure[path_1[0]]
+                >= engine.data.arrival[path_0[-1]] + min_layover
+            ],
+        )
+        price = lambda pair: engine.round_trip_sort_key(query, pair)[0]
+    if query.max_price is not None:
+        trips = [trip for trip in trips if price(trip) <= query.max_price]
+    return trips
+
+
+def trip_prices(engine, query, trips) -> list:
+    """Prices of trips as returned by search_paths, rounded to compare them"""
+    if query.round:
+        return [round(engine.round_trip_sort_key(query, pair)[0], 6) for pair in trips]
+    return [round(engine.path_price(query, path), 6) for path in trips]
+
+
+def random_query(data, random_generator) -> SearchQuery:
+    """Query between random airports of data with random filters. A third of the queries
+    are between sets of airports, which can share some of them"""
+    airports = random_generator.sample(list(data.airports), 3)
+    origin, destination = airports[0], airports[1]
+    if random_generator.random() < 1 / 3:
+        origin += "," + random_generator.choice(airports[1:])
+        destination += "," + airports[2]
+    days = sorted(
+        {seconds_to_timestamp(departure)[:10] for departure in data.departure}
+    )
+    return SearchQuery(
+        origin=origin,
+        destination=destination,
+        bags=random_generator.randint(0, 2),
+        round=random_generator.random() < 0.3,
+        min_layover_time=random_generator.choice([0, 1, 2]),
+        max_layover_time=random_generator.choice([3, 6, 10]),
+        depart_day=random_generator.choice([None, None, random_generator.choice(days)]),
+        stops=random_generator.choice([None, 0, 1, 2]),
+        trip_duration=random_generator.choice([None, 8.5, 20]),
+    )
+
+
+def check_searches(data, queries, random_generator) -> list:
+    """Compare the pruned recursive and iterative searches, --limit, --pareto and
+    --max-price, and the round trip join of every query in queries with enumerate_trips
+    over data. Returns the name and query of every mismatch"""
+    engine = FlightSearch(data)
+    iterative = FlightSearch(data, iterative=True)
+    failures = []
+    for query in queries:
+        expected = enumerate_trips(engine, query)
+        if engine.search_paths(query) != expected:
+            failures.append(("pruned search", query))
+        if iterative.search_paths(query) != expected:
+            failures.append(("iterative search", query))
+        limited = replace(query, limit=random_generator.randint(1, 5))
+        if trip_prices(engine, query, engine.search_paths(limited)) != trip_prices(
+            engine, query, expected[: limited.limit]
+        ):
+            failures.append(("limit", limited))
+        if expected:
+            budget = trip_prices(engine, query, [random_generator.choice(expected)])[0]
+            budgeted = replace(query, max_price=budget)
+            for search in (engine, iterative):
+                if search.search_paths(budgeted) != enumerate_trips(engine, budgeted):
+                    failures.append(("max_price", budgeted))
+        pareto = replace(
+            query,
+            pareto=True,
+            pareto_stops=random_generator.random() < 0.5,
+            max_price=random_generator.choice([None, budget]) if expected else None,
+        )
+        found = engine.search_paths(pareto)
+        if not query.round:
+            frontier = pareto_frontier(
+                enumerate_trips(engine, pareto),
+                lambda path: engine.pareto_criteria(pareto, path),
+            )
+            if found != frontier:
+                failures.append(("pareto", pareto))
+        else:
+            criteria = lambda pair: engine.pareto_round_trip_criteria(pareto, pair)
+            frontier = pareto_frontier(enumerate_trips(engine, pareto), criteria)
+            if {criteria(pair) for pair in found} != {
+                criteria(pair) for pair in frontier
+            } or not set(found) <= set(enumerate_trips(engine, pareto)):
+                failures.append(("pareto", pareto))
+    return failures
+
+
+def random_changes(data, rows, random_generator, count) -> list:
+    """count random changes to the flights of data, as returned by read_delta_file,
+    applying them to rows, the typed values of the flights of data in order"""
+    changes = []
+    for number in range(count):
+        op = random_generator.choice(CHANGE_OPERATIONS)
+        if op == "delete":
+            flight = rows.pop(random_generator.randrange(len(rows)))
+            changes.append((op, flight[0], flight[3], None))
+            continue
+        position = random_generator.randrange(len(rows))
+        flight_no, origin, _, departure, arrival, _, bag_price, _ = rows[position]
+        if op == "append":
+            flight_no = "CHECK{}".format(number)
+        destination = random_generator.choice(
+            [airport for airport in data.airports if airport != origin]
+        )
+        flight = (
+            flight_no,
+            origin,
+            destination,
+            departure,
+            max(departure, arrival + random_generator.choice([-1800, 0, 1800])),
+            float(random_generator.randint(1, 300)),
+            bag_price,
+            random_generator.randint(0, 2),
+        )
+        if op == "append":
+            rows.append(flight)
+        else:
+            rows[position] = flight
+        changes.append((op, flight_no, departure, flight))
+    return changes
+
+
+def check_changes(csv_file_path, queries, random_generator, rounds=3) -> list:
+    """Apply random changes to a query cache over the flights of csv_file_path and
+    compare its answers to queries with the ones over a dataset built from scratch with
+    the same changes. Returns the name and query of every mismatch"""
+    failures = []
+    for _ in range(rounds):
+        data = read_datasets(csv_file_path)
+        rows = [
+            (
+                data.flight_no[row],
+                data.airports[data.origin[row]],
+                data.airports[data.destination[row]],
+                data.departure[row],
+                data.arrival[row],
+                data.base_price[row],
+                data.bag_price[row],
+                data.bags_allowed[row],
+            )
+            for row in range(len(data))
+        ]
+        cache = QueryCache(FlightSearch(data), len(queries))
+        for query in queries:
+            cache.search(query)
+        cache.apply_changes(
+            random_changes(data, rows, random_generator, random_generator.randint(1, 8))
+        )
+        fresh = FlightTable()
+        for flight in rows:
+            fresh.append(*flight)
+        engine = FlightSearch(fresh)
+        for query in queries:
+            for variant in (
+                query,
+                replace(query, limit=3),
+                replace(query, pareto=True),
+            ):
+                if cache.search(variant) != engine.search(variant):
+                    failures.append(("changes", variant))
+    return failures
+
+
+def main(args):
+    """Main function. Check the searches over every dataset, exiting with an error if
+    any of them does not find the same trips as enumerate_trips"""
+    random_generator = random.Random(args.seed)
+    failures = []
+    for csv_file_path in expand_paths(args.csv_file_path):
+        data = read_datasets(csv_file_path)
+        queries = [random_query(data, random_generator) for _ in range(args.queries)]
+        dataset_failures = check_searches(data, queries, random_generator)
+        dataset_failures += check_changes(csv_file_path, queries, random_generator)
+        logger.info(
+            "{}: {} queries, {} mismatches".format(
+                csv_file_path, len(queries), len(dataset_failures)
+            )
+        )
+        for name, query in dataset_failures:
+            logger.error("{} differs in {}: {}".format(csv_file_path, name, query))
+        failures += dataset_failures
+    if failures:
+        exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Python weekend entry task regression checks. Compares the pruned, "
+        "iterative, cheapest-first, Pareto and budget searches, the round trip join and "
+        "the changes applied in place with a plain enumeration of every trip."
+    )
+    parser.add_argument(
+        "csv_file_path",
+        help="Relative paths or globs of the csv dataset files, each one checked on its own.",
+        type=str,
+        nargs="*",
+        default=["example/*.csv"],
+    )
+    parser.add_argument(
+        "-q",
+        "--queries",
+        help="Number of random queries per dataset.",
+        type=int,
+        default=100,
+    )
+    parser.add_argument(
+        "--seed", help="Seed of the random queries and changes.", type=int, default=0
+    )
+    main(parser.parse_args())
@@ -0,0 +1,493 @@
+import json
+import mmap
+import os
+import sys
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timedelta
+
+EPOCH = datetime(1970, 1, 1)
+DAY_SECONDS = 24 * 3600
+TIMESTAMPS_CACHE_SIZE = 1000000
+BINARY_MAGIC = b"FLTABLE4"
+BINARY_COLUMNS = (
+    "origin",
+    "destination",
+    "departure",
+    "arrival",
+    "base_price",
+    "bag_price",
+    "bags_allowed",
+    "index_rows",
+    "index_departures",
+    "index_starts",
+    "index_order",
+)
+
+
+def timestamp_to_seconds(timestamp) -> int:
+    """Parse a timestamp in format YYYY-MM-DDTHH:MM:SS and return the seconds since the epoch"""
+    return int((datetime.fromisoformat(timestamp) - EPOCH).total_seconds())
+
+
+def timestamps_to_seconds(timestamps, cache) -> list:
+    """Seconds since the epoch of timestamps in format YYYY-MM-DDTHH:MM:SS, or None for
+    the ones that are not a valid date and time. cache keeps the timestamps already
+    parsed, which repeat a lot in flight schedules"""
+    seconds = []
+    append = seconds.append
+    for timestamp in timestamps:
+        value = cache.get(timestamp, cache)
+        if value is cache:
+            try:
+                value = timestamp_to_seconds(timestamp)
+            except ValueError:
+                value = None
+            if len(cache) >= TIMESTAMPS_CACHE_SIZE:
+                cache.clear()
+            cache[timestamp] = value
+        append(value)
+    return seconds
+
+
+def seconds_to_timestamp(seconds) -> str:
+    """Format seconds since the epoch as a timestamp in format YYYY-MM-DDTHH:MM:SS"""
+    return (EPOCH + timedelta(seconds=seconds)).isoformat()
+
+
+class StringColumn:
+    """Read-only column of strings stored in a binary buffer as their utf-8 encoded bytes
+    one after the other, and the offsets where every string starts plus the final one"""
+
+    __slots__ = ("offsets", "blob")
+
+    def __init__(self, offsets, blob):
+        self.offsets = offsets
+        self.blob = blob
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, row) -> str:
+        return str(self.blob[self.offsets[row] : self.offsets[row + 1]], "utf-8")
+
+    def __iter__(self):
+        return (self[row] for row in range(len(self)))
+
+
+class FlightTable:
+    """Flights dataset stored as typed parallel columns.
+
+    A flight is identified by its row, the position of the flight in every column.
+    Times are stored as seconds since the epoch and airports as ids of the airports list.
+    A table loaded from a binary file reads its columns straight from the mapped file, and
+    only copies them into memory when it is modified. Flights can be added, updated and
+    deleted after the index is built, which is kept up to date. Deleted flights keep their
+    rows, so the rows of the others do not change, but are left out of the index.
+    """
+
+    __slots__ = (
+        "flight_no",
+        "origin",
+        "destination",
+        "departure",
+        "arrival",
+        "base_price",
+        "bag_price",
+        "bags_allowed",
+        "airports",
+        "airport_ids",
+        "index_rows",
+        "index_departures",
+        "index_starts",
+        "index_order",
+        "deleted",
+        "keys",
+        "buffer",
+    )
+
+    def __init__(self):
+        self.flight_no = []
+        self.origin = array("i")
+        self.destination = array("i")
+        self.departure = array("q")
+        self.arrival = array("q")
+        self.base_price = array("d")
+        self.bag_price = array("d")
+        self.bags_allowed = array("i")
+        self.airports = []
+        self.airport_ids = {}
+        self.index_rows = None
+        self.index_departures = None
+        self.index_starts = None
+        self.index_order = None
+        self.deleted = set()
+        self.keys = None
+        self.buffer = None
+
+    def __len__(self) -> int:
+        return len(self.flight_no)
+
+    def airport_id(self, code) -> int:
+        """Id of the airport code, registering it if it is new"""
+        airport_id = self.airport_ids.get(code)
+        if airport_id is None:
+            airport_id = len(self.airports)
+            self.airports.append(code)
+            self.airport_ids[code] = airport_id
+        return airport_id
+
+    def append(
+        self,
+        flight_no,
+        origin,
+        destination,
+        departure,
+        arrival,
+        base_price,
+        bag_price,
+        bags_allowed,
+    ) -> int:
+        """Add an already validated flight and return its row"""
+        if self.buffer is not None:
+            self.load_into_memory()
+        self.flight_no.append(flight_no)
+        self.origin.append(self.airport_id(origin))
+        self.destination.append(self.airport_id(destination))
+        self.departure.append(departure)
+        self.arrival.append(arrival)
+        self.base_price.append(base_price)
+        self.bag_price.append(bag_price)
+        self.bags_allowed.append(bags_allowed)
+        row = len(self.flight_no) - 1
+        if self.index_rows is not None:
+            self.index_flight(row)
+        return row
+
+    def update(
+        self,
+        row,
+        origin,
+        destination,
+        departure,
+        arrival,
+        base_price,
+        bag_price,
+        bags_allowed,
+    ) -> None:
+        """Replace the values of the flight in row with already validated ones"""
+        if self.buffer is not None:
+            self.load_into_memory()
+        indexed = self.index_rows is not None
+        if indexed:
+            self.unindex_flight(row)
+        self.origin[row] = self.airport_id(origin)
+        self.destination[row] = self.airport_id(destination)
+        self.departure[row] = departure
+        self.arrival[row] = arrival
+        self.base_price[row] = base_price
+        self.bag_price[row] = bag_price
+        self.bags_allowed[row] = bags_allowed
+        if indexed:
+            self.index_flight(row)
+
+    def delete(self, row) -> None:
+        """Delete the flight in row"""
+        if self.buffer is not None:
+            self.load_into_memory()
+        if self.index_rows is not None:
+            self.unindex_flight(row)
+        self.deleted.add(row)
+
+    def find(self, flight_no, departure):
+        """Row of the flight flight_no departing at departure, in seconds since the epoch,
+        or None if there is no such flight"""
+        if self.keys is None:
+            if self.index_rows is None:
+                self.build_index()
+            self.keys = {
+                (self.flight_no[row], self.departure[row]): row
+                for row in self.index_rows
+            }
+        return self.keys.get((flight_no, departure))
+
+    def extend(
+        self,
+        flight_no,
+        origin,
+        destination,
+        departure,
+        arrival,
+        base_price,
+        bag_price,
+        bags_allowed,
+    ) -> None:
+        """Add the columns of already validated flights"""
+        if self.buffer is not None:
+            self.load_into_memory()
+        airport_ids = self.airport_ids
+        airport_id = self.airport_id
+        self.flight_no.extend(flight_no)
+        for origin_code, destination_code in zip(origin, destination):
+            self.origin.append(
+                airport_ids[origin_code]
+                if origin_code in airport_ids
+                else airport_id(origin_code)
+            )
+            self.destination.append(
+                airport_ids[destination_code]
+                if destination_code in airport_ids
+                else airport_id(destination_code)
+            )
+        self.departure.extend(departure)
+        self.arrival.extend(arrival)
+        self.base_price.extend(base_price)
+        self.bag_price.extend(bag_price)
+        self.bags_allowed.extend(bags_allowed)
+        self.index_rows = None
+        self.keys = None
+
+    @classmethod
+    def merge(cls, tables) -> tuple:
+        """Table with the flights of tables in order, leaving out the deleted ones and the
+        ones with the flight_no and departure of an earlier one. Returns it and the number
+        of duplicates left out of every table"""
+        merged = cls()
+        seen = set()
+        duplicates = []
+        for table in tables:
+            rows = []
+            for row in range(len(table)):
+                if row in table.deleted:
+                    continue
+                key = (table.flight_no[row], table.departure[row])
+                if key not in seen:
+                    seen.add(key)
+                    rows.append(row)
+            duplicates.append(len(table) - len(table.deleted) - len(rows))
+            airports = table.airports
+            merged.extend(
+                [table.flight_no[row] for row in rows],
+                [airports[table.origin[row]] for row in rows],
+                [airports[table.destination[row]] for row in rows],
+                [table.departure[row] for row in rows],
+                [table.arrival[row] for row in rows],
+                [table.base_price[row] for row in rows],
+                [table.bag_price[row] for row in rows],
+                [table.bags_allowed[row] for row in rows],
+            )
+        return merged, duplicates
+
+    def flight(self, row) -> dict:
+        """Flight in row as a json-compatible dict"""
+        return {
+            "flight_no": self.flight_no[row],
+            "origin": self.airports[self.origin[row]],
+            "destination": self.airports[self.destination[row]],
+            "departure": seconds_to_timestamp(self.departure[row]),
+            "arrival": seconds_to_timestamp(self.arrival[row]),
+            "base_price": self.base_price[row],
+            "bag_price": self.bag_price[row],
+            "bags_allowed": self.bags_allowed[row],
+        }
+
+    def build_index(self) -> None:
+        """Index the flights by origin airport and departure time.
+
+        index_rows holds all rows sorted by origin and departure, index_departures their
+        departure times and the flights of the airport with id i are the ones between
+        index_starts[i] and index_starts[i + 1]. index_order holds all rows sorted by
+        departure and arrival, regardless of the airport. Deleted flights are left out.
+        """
+        rows = sorted(
+            (row for row in range(len(self)) if row not in self.deleted),
+            key=lambda row: (self.origin[row], self.departure[row]),
+        )
+        starts = array("i", [0] * (len(self.airports) + 1))
+        for row in rows:
+            starts[self.origin[row] + 1] += 1
+        for airport_id in range(len(self.airports)):
+            starts[airport_id + 1] += starts[airport_id]
+        self.index_rows = array("i", rows)
+        self.index_departures = array("q", [self.departure[row] for row in rows])
+        self.index_starts = starts
+        self.index_order = array(
+            "i", sorted(rows, key=lambda row: (self.departure[row], self.arrival[row]))
+        )
+        self.keys = None
+
+    def index_flight(self, row) -> None:
+        """Add the flight in row to the index"""
+        starts = self.index_starts
+        for _ in range(len(self.airports) + 1 - len(starts)):
+            starts.append(starts[-1])
+        origin = self.origin[row]
+        position = bisect_left(
+            self.index_rows,
+            self.index_key(row),
+            starts[origin],
+            starts[origin + 1],
+            key=self.index_key,
+        )
+        self.index_rows.insert(position, row)
+        self.index_departures.insert(position, self.departure[row])
+        for airport_id in range(origin + 1, len(starts)):
+            starts[airport_id] += 1
+        self.index_order.insert(
+            bisect_left(self.index_order, self.order_key(row), key=self.order_key), row
+        )
+        if self.keys is not None:
+            self.keys[(self.flight_no[row], self.departure[row])] = row
+
+    def unindex_flight(self, row) -> None:
+        """Remove the flight in row from the index"""
+        starts = self.index_starts
+        origin = self.origin[row]
+        position = bisect_left(
+            self.index_rows,
+            self.index_key(row),
+            starts[origin],
+            starts[origin + 1],
+            key=self.index_key,
+        )
+        del self.index_rows[position]
+        del self.index_departures[position]
+        for airport_id in range(origin + 1, len(starts)):
+            starts[airport_id] -= 1
+        del self.index_order[
+            bisect_left(self.index_order, self.order_key(row), key=self.order_key)
+        ]
+        if self.keys is not None:
+            key = (self.flight_no[row], self.departure[row])
+            if self.keys.get(key) == row:
+                del self.keys[key]
+
+    def index_key(self, row) -> tuple:
+        """Sort key of row among the flights of its origin airport in index_rows"""
+        return self.departure[row], row
+
+    def order_key(self, row) -> tuple:
+        """Sort key of row in index_order"""
+        return self.departure[row], self.arrival[row], row
+
+    def departing_from(self, airport_id, earliest=None, latest=None) -> list:
+        """Rows of the flights departing from airport_id between earliest and latest
+        (both included), in the same order as they were added"""
+        if self.index_rows is None:
+            self.build_index()
+        start = self.index_starts[airport_id]
+        end = self.index_starts[airport_id + 1]
+        if earliest is not None:
+            start = bisect_left(self.index_departures, earliest, start, end)
+        if latest is not None:
+            end = bisect_right(self.index_departures, latest, start, end)
+        return sorted(self.index_rows[start:end])
+
+    def load_into_memory(self) -> None:
+        """Copy the columns read from a binary file into memory, so they can be modified"""
+        for name in BINARY_COLUMNS:
+            column = getattr(self, name)
+            if isinstance(column, memoryview):
+                setattr(self, name, array(column.format, column))
+        self.flight_no = list(self.flight_no)
+        self.buffer = None
+
+    def __getstate__(self) -> dict:
+        if self.buffer is not None:
+            self.load_into_memory()
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __setstate__(self, state) -> None:
+        for name, value in state.items():
+            setattr(self, name, value)
+
+    def save(self, binary_file_path, source_version=None) -> None:
+        """Write the table and its index to a binary file that can be loaded without
+        parsing. source_version identifies the data the table was read from"""
+        if self.index_rows is None:
+            self.build_index()
+        encoded = [flight_no.encode("utf-8") for flight_no in self.flight_no]
+        offsets = array("q", [0])
+        for flight_no in encoded:
+            offsets.append(offsets[-1] + len(flight_no))
+        sections = [(name, getattr(self, name)) for name in BINARY_COLUMNS]
+        sections += [
+            ("flight_no_offsets", offsets),
+            ("flight_no", b"".join(encoded)),
+            ("deleted", array("i", sorted(self.deleted))),
+        ]
+        header = {
+            "byteorder": sys.byteorder,
+            "source_version": source_version,
+            "airports": self.airports,
+            "columns": {},
+        }
+        position = 0
+        for name, column in sections:
+            if isinstance(column, bytes):
+                header["columns"][name] = ["B", position, len(column)]
+                position += len(column)
+            else:
+                header["columns"][name] = [column.typecode, position, len(column)]
+                position += len(column) * column.itemsize
+            position += -position % 8
+        encoded_header = json.dumps(header).encode("utf-8")
+        encoded_header += b" " * (-len(encoded_header) % 8)
+        temporary_path = binary_file_path + ".tmp"
+        with open(temporary_path, "wb") as binary_file:
+            binary_file.write(BINARY_MAGIC)
+            binary_file.write(len(encoded_header).to_bytes(8, "little"))
+            binary_file.write(encoded_header)
+            for name, column in sections:
+                data = column if isinstance(column, bytes) else column.tobytes()
+                binary_file.write(data)
+                binary_file.write(b"\0" * (-len(data) % 8))
+        os.replace(temporary_path, binary_file_path)
+
+    @classmethod
+    def load(cls, binary_file_path) -> "FlightTable":
+        """Load a table written by save, mapping the file in memory instead of reading it"""
+        with open(binary_file_path, "rb") as binary_file:
+            buffer = mmap.mmap(binary_file.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(buffer)
+        if view[: len(BINARY_MAGIC)] != BINARY_MAGIC:
+            raise ValueError("{} is not a flights binary file".format(binary_file_path))
+        header_start = len(BINARY_MAGIC) + 8
+        header_length = int.from_bytes(view[len(BINARY_MAGIC) : header_start], "little")
+        header = json.loads(bytes(view[header_start : header_start + header_length]))
+        if header["byteorder"] != sys.byteorder:
+            raise ValueError(
+                "{} was written in another platform".format(binary_file_path)
+            )
+        columns = {}
+        data_start = header_start + header_length
+        for name, (typecode, position, length) in header["columns"].items():
+            itemsize = 1 if typecode == "B" else array(typecode).itemsize
+            start = data_start + position
+            columns[name] = view[start : start + length * itemsize].cast(typecode)
+        table = cls()
+        for name in BINARY_COLUMNS:
+            setattr(table, name, columns[name])
+        table.flight_no = StringColumn(
+            columns["flight_no_offsets"], columns["flight_no"]
+        )
+        table.deleted = set(columns["deleted"])
+        table.airports = header["airports"]
+        table.airport_ids = {code: i for i, code in enumerate(table.airports)}
+        table.buffer = buffer
+        return table
+
+
+def binary_source_version(binary_file_path):
+    """source_version the binary file was saved with, or None if it can not be read"""
+    try:
+        with open(binary_file_path, "rb") as binary_file:
+            if binary_file.read(len(BINARY_MAGIC)) != BINARY_MAGIC:
+                return None
+            header_length = int.from_bytes(binary_file.read(8), "little")
+            header = json.loads(binary_file.read(header_length))
+    except (OSError, ValueError):
+        return None
+    if header.get("byteorder") != sys.byteorder or header.get("source_version") is None:
+        return None
+    return tuple(header["source_version"])
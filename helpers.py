@@ -1,198 +1,480 @@
 import logging
 import os
 import csv
+import glob
+import itertools
 import re
-from datetime import timedelta
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from dataset import (
+    FlightTable,
+    binary_source_version,
+    timestamp_to_seconds,
+    timestamps_to_seconds,
+)
+from stats import SearchStats, phase
 
 logger = logging.getLogger(__name__)
 
+FLIGHT_FIELDS = (
+    "flight_no",
+    "origin",
+    "destination",
+    "departure",
+    "arrival",
+    "base_price",
+    "bag_price",
+    "bags_allowed",
+)
+# Number of csv rows read and validated at once
+CHUNK_SIZE = 10000
+DELTA_OPERATIONS = ("append", "update", "delete")
+TIMESTAMP = re.compile(r"\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}$")
+REJECTION_REASONS = {
+    "missing_fields": "some fields are missing",
+    "same_airports": "origin and destination are the same",
+    "departure_format": "departure is not in format YYYY-MM-DDTHH:MM:SS",
+    "arrival_format": "arrival is not in format YYYY-MM-DDTHH:MM:SS",
+    "invalid_date": "departure or arrival is not a valid date",
+    "arrival_before_departure": "arrival is before departure",
+    "base_price_format": "base_price is not a number",
+    "bag_price_format": "bag_price is not a number",
+    "bags_allowed_format": "bags_allowed is not an integer",
+    "negative_base_price": "base_price is negative",
+    "negative_bag_price": "bag_price is negative",
+    "negative_bags_allowed": "bags_allowed is negative",
+}
 
-def parse_ranges(args) -> None:
-    """Parse the ranges of dates and times"""
-    outbound_range = [None, None]
-    if args.depart_day is not None:
-        outbound_range = [args.depart_day + "T00:00:00", args.depart_day + "T23:59:59"]
-        if args.outbound_range is not None:
-            outbound_range = [
-                args.depart_day + "T" + args.outbound_range.split("-")[0],
-                args.depart_day + "T" + args.outbound_range.split("-")[1],
-            ]
-    elif args.outbound_range is not None:
-        outbound_range = [
-            args.outbound_range.split("-")[0],
-            args.outbound_range.split("-")[1],
-        ]
-    return_range = [None, None]
-    if args.return_day is not None:
-        return_range = [args.return_day + "T00:00:00", args.return_day + "T23:59:59"]
-        if args.return_range is not None:
-            return_range = [
-                args.return_day + "T" + args.return_range.split("-")[0],
-                args.return_day + "T" + args.return_range.split("-")[1],
-            ]
-    elif args.return_range is not None:
-        return_range = [
-            args.return_range.split("-")[0],
-            args.return_range.split("-")[1],
-        ]
-    return outbound_range, return_range
-
-
-def read_csv_file(csv_file_path) -> list:
-    """Read csv file and return a json-compatible structured list of trips"""
+
+def parse_ranges(args) -> tuple:
+    """Parse the ranges of dates and times of the outbound and the return flights. Every
+    way gets a list of [start, end] ranges its first flight has to depart in, both either
+    a full timestamp or a time of day"""
+    return (
+        departure_ranges(args.depart_day, args.outbound_range),
+        departure_ranges(args.return_day, args.return_range),
+    )
+
+
+def departure_ranges(days, times) -> list:
+    """Ranges of parse_ranges for a day or range of days and a range of times of day"""
+    ranges = []
+    if days is not None:
+        first, last = parse_days(days)
+        ranges.append([first + "T00:00:00", last + "T23:59:59"])
+    if times is not None:
+        ranges.append(times.split("-"))
+    return ranges
+
+
+def compile_ranges(ranges) -> tuple:
+    """Compile ranges of parse_ranges into the earliest and latest departure they allow,
+    in seconds since the epoch, and the earliest and latest time of day, in seconds since
+    midnight, each None if it is not bounded"""
+    bounds = [None, None, None, None]
+    for range_bounds in ranges:
+        for position, bound in enumerate(range_bounds):
+            if bound is None:
+                continue
+            if "T" in bound:
+                value = timestamp_to_seconds(bound)
+            else:
+                hours, minutes, seconds = bound.split(":")
+                value = int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+                position += 2
+            if (
+                bounds[position] is None
+                or (position % 2 == 0 and value > bounds[position])
+                or (position % 2 == 1 and value < bounds[position])
+            ):
+                bounds[position] = value
+    return tuple(bounds)
+
+
+def parse_days(days) -> tuple:
+    """First and last day of a day in format YYYY-MM-DD or a range of days in format
+    YYYY-MM-DD/YYYY-MM-DD"""
+    first, _, last = days.partition("/")
+    return first, last or first
+
+
+def split_airports(codes) -> list:
+    """Airport codes of a code or several ones separated by commas, without repetitions"""
+    return list(
+        dict.fromkeys(code.strip() for code in codes.split(",") if code.strip())
+    )
+
+
+def read_dataset(csv_file_path, binary_cache=False, stats=None) -> FlightTable:
+    """Read the flights of the csv file. With binary_cache they are loaded from a binary
+    file next to it instead, which is written again whenever the csv file changes. The
+    rows loaded and rejected are counted in stats, a SearchStats"""
+    if not binary_cache:
+        return read_csv_file(csv_file_path, stats=stats)
+    if not os.path.exists(csv_file_path):
+        logger.error("File {} does not exist".format(csv_file_path))
+        exit(1)
+    version = dataset_version(csv_file_path)
+    binary_file_path = csv_file_path + ".flights"
+    if binary_source_version(binary_file_path) == version:
+        data = FlightTable.load(binary_file_path)
+        if stats is not None:
+            stats.count("rows_loaded", len(data))
+        return data
+    data = read_csv_file(csv_file_path, stats=stats)
+    try:
+        data.save(binary_file_path, version)
+    except OSError as e:
+        logger.warning("Could not write {}: {}".format(binary_file_path, e))
+    return data
+
+
+def read_datasets(
+    csv_file_paths, binary_cache=False, stats=None, workers=None
+) -> FlightTable:
+    """Read the flights of several csv files, given as paths or globs, see expand_paths.
+    Every file is read with read_dataset in a thread pool of workers threads, so the
+    files are read and validated at the same time and waiting for a slow one does not
+    hold the others back.
+
+    The flights are merged in the order of the files, leaving out the ones with the
+    flight_no and departure of a flight already read, from the same file or an earlier
+    one, as duplicates. The flights read, rejected and left out of every file are
+    logged, and stats gets them in its files"""
+    paths = expand_paths(csv_file_paths)
+    if len(paths) == 1:
+        return read_dataset(paths[0], binary_cache, stats)
+
+    def read(path, file_stats):
+        start = time.perf_counter()
+        data = read_dataset(path, binary_cache, file_stats)
+        file_stats.phases["load"] += time.perf_counter() - start
+        return data
+
+    files_stats = [SearchStats() for _ in paths]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        tables = list(executor.map(read, paths, files_stats))
+    data, duplicates = FlightTable.merge(tables)
+    for path, file_stats, file_duplicates in zip(paths, files_stats, duplicates):
+        file_duplicates += file_stats.counters["duplicates_dropped"]
+        logger.info(
+            "{}: {} flights read, {} invalid, {} duplicates".format(
+                path,
+                file_stats.counters["rows_loaded"],
+                sum(file_stats.rejected.values()),
+                file_duplicates,
+            )
+        )
+        if stats is not None:
+            stats.phases["validation"] += file_stats.phases["validation"]
+            stats.rejected.update(file_stats.rejected)
+            stats.count("duplicates_dropped", file_duplicates)
+            stats.files[path] = {
+                "seconds": file_stats.phases["load"],
+                "rows_loaded": file_stats.counters["rows_loaded"],
+                "rows_rejected": dict(file_stats.rejected),
+                "duplicates_dropped": file_duplicates,
+            }
+    if stats is not None:
+        stats.count("rows_loaded", len(data))
+    return data
+
+
+def expand_paths(csv_file_paths) -> list:
+    """Paths of the files matching csv_file_paths, a path or glob or a list of them, in
+    order and without repetitions. Globs are sorted, and kept as they are if they match
+    no file, so reading them reports that it does not exist"""
+    if isinstance(csv_file_paths, str):
+        csv_file_paths = [csv_file_paths]
+    paths = []
+    for pattern in csv_file_paths:
+        paths.extend(sorted(glob.glob(pattern)) or [pattern])
+    return list(dict.fromkeys(paths))
+
+
+def datasets_version(csv_file_paths) -> tuple:
+    """Paths and dataset_version of the files matching csv_file_paths, which change
+    whenever one of them is written or a glob matches other files"""
+    return tuple((path, dataset_version(path)) for path in expand_paths(csv_file_paths))
+
+
+def dataset_version(csv_file_path) -> tuple:
+    """Modification time and size of the csv file, which change whenever it is written"""
+    stat = os.stat(csv_file_path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def read_csv_file(csv_file_path, chunk_size=CHUNK_SIZE, stats=None) -> FlightTable:
+    """Read csv file and return the table of its valid flights, leaving out the ones with
+    the flight_no and departure of an earlier one as duplicates, like FlightTable.merge
+    """
+    data = FlightTable()
+    rejected = Counter()
+    seen = set()
+    duplicates = 0
+    for flights, rejections in iter_csv_chunks(csv_file_path, chunk_size, stats):
+        mask = []
+        for key in zip(flights[0], flights[3]):
+            mask.append(key not in seen)
+            seen.add(key)
+        if not all(mask):
+            duplicates += mask.count(False)
+            flights = [list(itertools.compress(column, mask)) for column in flights]
+        data.extend(*flights)
+        for flight_no, departure, reason in rejections:
+            rejected[reason] += 1
+            logger.debug(
+                "Flight %s departing at %s is invalid because %s",
+                flight_no,
+                departure,
+                REJECTION_REASONS[reason],
+            )
+    for reason, count in rejected.items():
+        logger.info(
+            "{} flights are invalid because {}".format(count, REJECTION_REASONS[reason])
+        )
+    if duplicates:
+        logger.info("{} flights are duplicates of earlier ones".format(duplicates))
+    if stats is not None:
+        stats.count("rows_loaded", len(data))
+        stats.count("duplicates_dropped", duplicates)
+        stats.rejected.update(rejected)
+    return data
+
+
+def iter_csv_chunks(csv_file_path, chunk_size=CHUNK_SIZE, stats=None):
+    """Read csv file chunk_size rows at a time, generating for every chunk the columns
+    of its valid flights, in the order of FlightTable.extend, and the flight_no,
+    departure and reason of every invalid one, see validate_rows. The time spent
+    validating is added to the "validation" phase of stats"""
     if not os.path.exists(csv_file_path):
         logger.error("File {} does not exist".format(csv_file_path))
         exit(1)
-    with open(csv_file_path, "r") as csv_file:
-        reader = csv.DictReader(csv_file)
-        if (
-            "flight_no" not in reader.fieldnames
-            or "origin" not in reader.fieldnames
-            or "destination" not in reader.fieldnames
-            or "departure" not in reader.fieldnames
-            or "arrival" not in reader.fieldnames
-            or "base_price" not in reader.fieldnames
-            or "bag_price" not in reader.fieldnames
-            or "bags_allowed" not in reader.fieldnames
-        ):
+    with open(csv_file_path, "r", newline="") as csv_file:
+        reader = csv.reader(csv_file)
+        fieldnames = next(reader, [])
+        if any(field not in fieldnames for field in FLIGHT_FIELDS):
             logger.error(
                 "The csv file must contain the following fields: flight_no, origin, destination, departure, arrival, base_price, bag_price, bags_allowed"
             )
             exit(1)
-        return [f for f in reader if flight_is_valid(f)]
+        positions = [fieldnames.index(field) for field in FLIGHT_FIELDS]
+        timestamps = {}
+        while True:
+            rows = list(itertools.islice(reader, chunk_size))
+            if not rows:
+                break
+            # Blank lines are read as empty rows, which are not flights
+            rows = [row for row in rows if row]
+            with phase(stats, "validation"):
+                chunk = validate_rows(rows, positions, timestamps)
+            yield chunk
+
+
+def read_delta_file(delta_file_path) -> list:
+    """Read a file of changes to a dataset, a csv file with the fields of FLIGHT_FIELDS
+    and an op field that is append, update or delete. Flights are identified by flight_no
+    and departure, which are the only fields deletions need.
+
+    Returns the valid changes in order as (op, flight_no, departure in seconds since the
+    epoch, flight), where flight has the typed values in the order of FlightTable.append
+    or is None for deletions. Invalid changes are logged and skipped"""
+    if not os.path.exists(delta_file_path):
+        raise ValueError("File {} does not exist".format(delta_file_path))
+    changes = []
+    with open(delta_file_path, "r", newline="") as delta_file:
+        reader = csv.DictReader(delta_file)
+        fieldnames = reader.fieldnames or []
+        if any(field not in fieldnames for field in ("op", "flight_no", "departure")):
+            raise ValueError(
+                "The delta file must contain the fields op, flight_no and departure"
+            )
+        for change in reader:
+            op = (change["op"] or "").strip().lower()
+            if op not in DELTA_OPERATIONS:
+                logger.info(
+                    "Change of flight {} departing at {} is invalid because op must be one of {}".format(
+                        change["flight_no"],
+                        change["departure"],
+                        ", ".join(DELTA_OPERATIONS),
+                    )
+                )
+                continue
+            if op == "delete":
+                departure = change["departure"] or ""
+                seconds = None
+                if TIMESTAMP.match(departure) is not None:
+                    seconds = timestamps_to_seconds([departure], {})[0]
+                if seconds is None:
+                    logger.info(
+                        "Deletion of flight {} departing at {} is invalid because {}".format(
+                            change["flight_no"],
+                            departure,
+                            REJECTION_REASONS["departure_format"],
+                        )
+                    )
+                    continue
+                changes.append((op, change["flight_no"], seconds, None))
+                continue
+            flight = parse_flight(change)
+            if flight is not None:
+                changes.append((op, flight[0], flight[3], flight))
+    return changes
+
+
+def validate_rows(rows, positions, timestamps=None) -> tuple:
+    """Validate csv rows column by column, with the fields of FLIGHT_FIELDS in positions.
+
+    Returns the columns of the valid flights, in the order of FlightTable.extend, and a
+    list with the flight_no, departure and key of REJECTION_REASONS of every invalid
+    flight. Every check runs over a whole column of the rows still valid, in the same
+    order as parse_flight. timestamps caches the timestamps already parsed"""
+    if timestamps is None:
+        timestamps = {}
+    width = max(positions) + 1
+    rejections = [
+        (row[0] if row else "", "", "missing_fields")
+        for row in rows
+        if len(row) < width
+    ]
+    if rejections:
+        rows = [row for row in rows if len(row) >= width]
+    columns = [[row[position] for row in rows] for position in positions]
+    # The departures as read are kept last to report the invalid flights
+    columns.append(columns[3])
+
+    def keep(mask, reason):
+        """Drop from columns the flights that are false in mask"""
+        nonlocal columns
+        if all(mask):
+            return
+        rejections.extend(
+            (flight_no, departure, reason)
+            for flight_no, departure, valid in zip(columns[0], columns[-1], mask)
+            if not valid
+        )
+        columns = [list(itertools.compress(column, mask)) for column in columns]
+
+    keep([o != d for o, d in zip(columns[1], columns[2])], "same_airports")
+    # Only timestamps in the right format are cached, so those skip the regex
+    keep(
+        [t in timestamps or TIMESTAMP.match(t) is not None for t in columns[3]],
+        "departure_format",
+    )
+    keep(
+        [t in timestamps or TIMESTAMP.match(t) is not None for t in columns[4]],
+        "arrival_format",
+    )
+    columns[3] = timestamps_to_seconds(columns[3], timestamps)
+    columns[4] = timestamps_to_seconds(columns[4], timestamps)
+    keep(
+        [d is not None and a is not None for d, a in zip(columns[3], columns[4])],
+        "invalid_date",
+    )
+    keep([d <= a for d, a in zip(columns[3], columns[4])], "arrival_before_departure")
+    columns[5] = list(map(to_float, columns[5]))
+    keep([value is not None for value in columns[5]], "base_price_format")
+    columns[6] = list(map(to_float, columns[6]))
+    keep([value is not None for value in columns[6]], "bag_price_format")
+    columns[7] = list(map(to_int, columns[7]))
+    keep([value is not None for value in columns[7]], "bags_allowed_format")
+    keep([value >= 0 for value in columns[5]], "negative_base_price")
+    keep([value >= 0 for value in columns[6]], "negative_bag_price")
+    keep([value >= 0 for value in columns[7]], "negative_bags_allowed")
+    return columns[:-1], rejections
 
 
-def timedelta_parse(string) -> timedelta:
-    """Parse a string in format [DD days, ]HH:MM:SS and return a timedelta object"""
-    h, m, s = string.split(":")
-    if "day" in h:
-        h = int(h.split(" ")[0]) * 24 + int(h.split(" ")[-1])
-    return timedelta(hours=int(h), minutes=int(m), seconds=int(s))
+def to_float(string):
+    """string as a float, or None if it is not a number"""
+    try:
+        return float(string)
+    except ValueError:
+        return None
 
 
-def is_full_timestamp(timestamp) -> bool:
-    """Check if a timestamp is in full format (YYYY-MM-DDTHH:MM:SS)"""
-    return re.match(r"^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}$", timestamp)
+def to_int(string):
+    """string as an int, or None if it is not an integer"""
+    try:
+        return int(string)
+    except ValueError:
+        return None
+
+
+def is_day_range(days) -> bool:
+    """Check if days is a valid day in format YYYY-MM-DD or a range of valid days in
+    format YYYY-MM-DD/YYYY-MM-DD that does not end before it starts"""
+    if not re.match(r"^\d{4}-\d{2}-\d{2}(/\d{4}-\d{2}-\d{2})?$", days):
+        return False
+    first, last = parse_days(days)
+    try:
+        return date.fromisoformat(first) <= date.fromisoformat(last)
+    except ValueError:
+        return False
 
 
 def check_input_arguments(args) -> None:
     """Check if the input arguments are valid"""
-    if args.bags is not None and args.bags < 0:
-        logger.error("--bags must be a positive integer")
+    error = input_arguments_error(args)
+    if error is not None:
+        logger.error(error)
         exit(1)
+
+
+def input_arguments_error(args):
+    """Error message of the first invalid input argument, or None if all of them are valid"""
+    if args.bags is not None and args.bags < 0:
+        return "--bags must be a positive integer"
     if args.min_layover_time is not None and args.min_layover_time < 0:
-        logger.error("--min-layover-time must be a positive integer")
-        exit(1)
+        return "--min-layover-time must be a positive integer"
     if args.max_layover_time is not None and args.max_layover_time < 0:
-        logger.error("--max-layover-time must be a positive integer")
-        exit(1)
-    if args.depart_day is not None and not re.match(
-        r"^\d{4}-\d{2}-\d{2}$", args.depart_day
-    ):
-        logger.error("--depart-day must be in format YYYY-MM-DD")
-        exit(1)
-    if args.return_day is not None and not re.match(
-        r"^\d{4}-\d{2}-\d{2}$", args.return_day
-    ):
-        logger.error("--return-day must be in format YYYY-MM-DD")
-        exit(1)
+        return "--max-layover-time must be a positive integer"
+    if not split_airports(args.origin) or not split_airports(args.destination):
+        return "origin and destination must contain at least one airport code"
+    if args.depart_day is not None and not is_day_range(args.depart_day):
+        return "--depart-day must be in format YYYY-MM-DD or YYYY-MM-DD/YYYY-MM-DD"
+    if args.return_day is not None and not is_day_range(args.return_day):
+        return "--return-day must be in format YYYY-MM-DD or YYYY-MM-DD/YYYY-MM-DD"
     if args.stops is not None and args.stops < 0:
-        logger.error("--stops must be a positive integer")
-        exit(1)
+        return "--stops must be a positive integer"
     if args.outbound_range is not None and not re.match(
         r"^\d{2}:\d{2}:\d{2}-\d{2}:\d{2}:\d{2}$", args.outbound_range
     ):
-        logger.error("--outbound-range must be in format HH:MM:SS-HH:MM:SS")
-        exit(1)
+        return "--outbound-range must be in format HH:MM:SS-HH:MM:SS"
     if args.return_range is not None and not re.match(
         r"^\d{2}:\d{2}:\d{2}-\d{2}:\d{2}:\d{2}$", args.return_range
     ):
-        logger.error("--return-range must be in format HH:MM:SS-HH:MM:SS")
-        exit(1)
+        return "--return-range must be in format HH:MM:SS-HH:MM:SS"
     if args.trip_duration is not None and args.trip_duration < 0:
-        logger.error("--trip-duration must be a positive integer")
-        exit(1)
+        return "--trip-duration must be a positive integer"
+    if args.limit is not None and args.limit < 0:
+        return "--limit must be a positive integer"
+    if args.max_price is not None and args.max_price < 0:
+        return "--max-price must be a positive number"
+    return None
 
 
 def flight_is_valid(flight) -> bool:
     """Check if a flight is valid"""
-    if flight["origin"] == flight["destination"]:
-        logger.info(
-            "Flight {} departing at {} is invalid because origin and destination are the same".format(
-                flight["flight_no"], flight["departure"]
-            )
-        )
-        return False
-    if not re.match(r"^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}$", flight["departure"]):
-        logger.info(
-            "Flight {} departing at {} is invalid because departure is not in format YYYY-MM-DDTHH:MM:SS".format(
-                flight["flight_no"], flight["departure"]
-            )
-        )
-        return False
-    if not re.match(r"^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}$", flight["arrival"]):
-        logger.info(
-            "Flight {} departing at {} is invalid because arrival is not in format YYYY-MM-DDTHH:MM:SS".format(
-                flight["flight_no"], flight["arrival"]
-            )
-        )
-        return False
-    if flight["departure"] > flight["arrival"]:
-        logger.info(
-            "Flight {} departing at {} is invalid because arrival is before departure".format(
-                flight["flight_no"], flight["departure"]
-            )
-        )
-        return False
-    try:
-        float(flight["base_price"])
-    except ValueError:
-        logger.info(
-            "Flight {} departing at {} is invalid because base_price is not a number".format(
-                flight["flight_no"], flight["departure"]
-            )
-        )
-        return False
-    try:
-        float(flight["bag_price"])
-    except ValueError:
-        logger.info(
-            "Flight {} departing at {} is invalid because bag_price is not a number".format(
-                flight["flight_no"], flight["departure"]
-            )
-        )
-        return False
-    try:
-        int(flight["bags_allowed"])
-    except ValueError:
-        logger.info(
-            "Flight {} departing at {} is invalid because bags_allowed is not an integer".format(
-                flight["flight_no"], flight["departure"]
-            )
-        )
-        return False
-    if float(flight["base_price"]) < 0:
-        logger.info(
-            "Flight {} departing at {} is invalid because base_price is negative".format(
-                flight["flight_no"], flight["departure"]
-            )
-        )
-        return False
-    if float(flight["bag_price"]) < 0:
-        logger.info(
-            "Flight {} departing at {} is invalid because bag_price is negative".format(
-                flight["flight_no"], flight["departure"]
-            )
-        )
-        return False
-    if int(flight["bags_allowed"]) < 0:
+    return parse_flight(flight) is not None
+
+
+def parse_flight(flight):
+    """Check if a flight is valid and return its typed values in the order expected by
+    FlightTable.append, or None if it is not valid"""
+    row = [flight.get(field) for field in FLIGHT_FIELDS]
+    columns, rejections = validate_rows([[] if None in row else row], range(8))
+    if rejections:
         logger.info(
-            "Flight {} departing at {} is invalid because bags_allowed is negative".format(
-                flight["flight_no"], flight["departure"]
+            "Flight {} departing at {} is invalid because {}".format(
+                flight.get("flight_no"),
+                flight.get("departure"),
+                REJECTION_REASONS[rejections[0][2]],
             )
         )
-        return False
-    return True
+        return None
+    return tuple(column[0] for column in columns)
 
 
 ############################################
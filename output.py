@@ -0,0 +1,85 @@
+import json
+
+INDENT = " " * 4
+
+
+def indent(text, levels=1) -> str:
+    """text with every line but the first one indented levels more times. Strings in json
+    can not contain new lines, so this is safe for json.dumps output"""
+    return text.replace("\n", "\n" + INDENT * levels)
+
+
+def iter_json_array(items, levels=0):
+    """Generate the text of the json array of items in chunks, one per item, which joined
+    are the same as json.dumps(list(items), indent=4) indented levels times"""
+    items = iter(items)
+    first = next(items, None)
+    if first is None:
+        yield "[]"
+        return
+    yield "[\n" + INDENT * (levels + 1) + indent(
+        json.dumps(first, indent=4), levels + 1
+    )
+    for item in items:
+        yield ",\n" + INDENT * (levels + 1) + indent(
+            json.dumps(item, indent=4), levels + 1
+        )
+    yield "\n" + INDENT * levels + "]"
+
+
+def flight_table(paths, round_trip=False) -> dict:
+    """Position of every row of paths in the table of the flights they use, in order of
+    first appearance"""
+    table = {}
+    for path in paths:
+        for row in path[0] + path[1] if round_trip else path:
+            if row not in table:
+                table[row] = len(table)
+    return table
+
+
+def iter_output(engine, query, paths, ndjson=False, compact=False):
+    """Generate the text of the results of query, paths as returned by
+    FlightSearch.search_paths, in chunks, building every combination only when it is
+    written.
+
+    By default the chunks make up the same json array as json.dumps(results, indent=4).
+    With ndjson every combination is one line of json instead. With compact the flights
+    are written once in a "flights" table and every combination refers to them by their
+    position in it, as a json object with the "flights" and the "combinations" or, with
+    ndjson, as a first line with the "flights" and then one line per combination."""
+    combinations = engine.iter_combinations(query, paths)
+    if compact:
+        table = flight_table(paths, query.round)
+        flights = [engine.data.flight(row) for row in table]
+        combinations = (
+            dict(
+                combination,
+                flights=[
+                    table[row] for row in (path[0] + path[1] if query.round else path)
+                ],
+            )
+            for path, combination in zip(paths, combinations)
+        )
+        if ndjson:
+            yield json.dumps({"flights": flights}) + "\n"
+        else:
+            yield "{\n" + INDENT + '"flights": ' + indent(json.dumps(flights, indent=4))
+            yield ",\n" + INDENT + '"combinations": '
+            yield from iter_json_array(combinations, 1)
+            yield "\n}\n"
+            return
+    if ndjson:
+        for combination in combinations:
+            yield json.dumps(combination) + "\n"
+        return
+    yield from iter_json_array(combinations)
+    yield "\n"
+
+
+def write_output(sinks, engine, query, paths, ndjson=False, compact=False) -> None:
+    """Write the results of query to every file in sinks, see iter_output. Every chunk
+    is only serialised once"""
+    for chunk in iter_output(engine, query, paths, ndjson, compact):
+        for sink in sinks:
+            sink.write(chunk)
@@ -0,0 +1,1223 @@
+import copy
+import heapq
+import itertools
+import logging
+import math
+from bisect import bisect_left, bisect_right, insort
+from dataclasses import dataclass, fields
+from datetime import timedelta
+from dataset import DAY_SECONDS, seconds_to_timestamp
+from helpers import (
+    datasets_version,
+    compile_ranges,
+    input_arguments_error,
+    parse_ranges,
+    read_datasets,
+    split_airports,
+)
+from stats import phase
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class SearchQuery:
+    """Route and filters of a search, with the same meaning as the command line arguments.
+    origin and destination can be several airport codes separated by commas, and
+    depart_day and return_day ranges of days, see flexible"""
+
+    origin: str
+    destination: str
+    bags: int = 0
+    round: bool = False
+    min_layover_time: int = 1
+    max_layover_time: int = 6
+    depart_day: str = None
+    return_day: str = None
+    stops: int = None
+    outbound_range: str = None
+    return_range: str = None
+    trip_duration: float = None
+    limit: int = None
+    pareto: bool = False
+    pareto_stops: bool = False
+    max_price: float = None
+
+    @classmethod
+    def from_args(cls, args) -> "SearchQuery":
+        """Build the query from the parsed command line arguments"""
+        return cls(
+            origin=args.origin,
+            destination=args.destination,
+            bags=args.bags,
+            round=args.round,
+            min_layover_time=args.min_layover_time,
+            max_layover_time=args.max_layover_time,
+            depart_day=args.depart_day,
+            return_day=args.return_day,
+            stops=args.stops,
+            outbound_range=args.outbound_range,
+            return_range=args.return_range,
+            trip_duration=args.trip_duration,
+            limit=args.limit,
+            pareto=args.pareto,
+            pareto_stops=args.pareto_stops,
+            max_price=args.max_price,
+        )
+
+    @property
+    def flexible(self) -> bool:
+        """Whether the trips can start or end at several airports or on several days, in
+        which case the results say which ones they do"""
+        return (
+            len(split_airports(self.origin)) > 1
+            or len(split_airports(self.destination)) > 1
+            or any(
+                day is not None and "/" in day
+                for day in (self.depart_day, self.return_day)
+            )
+        )
+
+    @classmethod
+    def from_dict(cls, values) -> "SearchQuery":
+        """Build the query from a dict keyed by the long names of the command line
+        arguments, with dashes or underscores, e.g. {"origin": "WUE", "destination": "JBN",
+        "return": true, "max-layover-time": 8}. origin and destination can also be lists
+        of airport codes. null is only accepted for the arguments that are not set by
+        default, true and false only for the flags and whole numbers only for the integer
+        arguments"""
+        types = {field.name: field.type for field in fields(cls)}
+        defaults = {field.name: field.default for field in fields(cls)}
+        arguments = {}
+        for key, value in values.items():
+            name = "round" if key == "return" else key.replace("-", "_")
+            if name not in types:
+                raise ValueError("Unknown query argument {}".format(key))
+            if value is None and defaults[name] is not None:
+                raise ValueError("{} can not be null".format(key))
+            if name in ("origin", "destination"):
+                if isinstance(value, list) and all(
+                    isinstance(code, str) for code in value
+                ):
+                    value = ",".join(value)
+                if not isinstance(value, str) or not split_airports(value):
+                    raise ValueError("Invalid value {} for {}".format(value, key))
+            if types[name] is bool and isinstance(value, str):
+                if value.lower() not in ("true", "false", "1", "0", ""):
+                    raise ValueError("Invalid value {} for {}".format(value, key))
+                value = value.lower() in ("true", "1")
+            # bool is a subclass of int, so true and false would pass for numbers
+            if value is not None and (
+                not isinstance(value, types[name])
+                or (isinstance(value, bool) and types[name] is not bool)
+            ):
+                if types[name] is bool or isinstance(value, bool):
+                    raise ValueError("Invalid value {} for {}".format(value, key))
+                if types[name] is int and isinstance(value, float):
+                    if not value.is_integer():
+                        raise ValueError("Invalid value {} for {}".format(value, key))
+                try:
+                    value = types[name](value)
+                except (TypeError, ValueError):
+                    raise ValueError("Invalid value {} for {}".format(value, key))
+            arguments[name] = value
+        if "origin" not in arguments or "destination" not in arguments:
+            raise ValueError("origin and destination are required")
+        return cls(**arguments)
+
+
+class FlightSearch:
+    """Search engine answering queries over one loaded dataset.
+
+    Searches only read the dataset and its index and keep their state in local variables,
+    so one engine can answer queries from several threads at once or be sent to other
+    processes. apply_changes modifies the dataset in place, so it must not run at the
+    same time as a search.
+
+    Trips are handled as paths, tuples with the rows of their flights, and only turned
+    into json-compatible combinations at the end. Flights that do not allow the bags of a
+    query are left out of its trips, with a mask built once for every number of bags."""
+
+    def __init__(self, data, iterative=False):
+        self.data = data
+        self.iterative = iterative
+        self.stats = None
+        self.reached = None
+        self.bags_masks = {}
+        self.source = None
+        self.version = None
+        self.binary_cache = False
+        if data.index_rows is None:
+            data.build_index()
+
+    @classmethod
+    def from_csv(
+        cls, csv_file_path, binary_cache=False, iterative=False
+    ) -> "FlightSearch":
+        """Build the engine from the flights of a csv file, or several ones given as a list
+        of paths or globs, see read_datasets. If iterative trips are found with
+        iterative_search instead of recursive_search"""
+        version = datasets_version(csv_file_path)
+        engine = cls(read_datasets(csv_file_path, binary_cache), iterative)
+        engine.source = csv_file_path
+        engine.version = version
+        engine.binary_cache = binary_cache
+        return engine
+
+    def is_outdated(self) -> bool:
+        """Check if the csv files the dataset was read from changed since then"""
+        return self.source is not None and datasets_version(self.source) != self.version
+
+    def with_stats(self, stats) -> "FlightSearch":
+        """Engine over the same dataset that records the phase times and counters of its
+        searches in stats, a SearchStats"""
+        engine = copy.copy(self)
+        engine.stats = stats
+        return engine
+
+    def with_reached(self, reached) -> "FlightSearch":
+        """Engine over the same dataset that adds to the set reached the codes of the
+        airports its searches can reach, the only ones whose departing flights can change
+        their results"""
+        engine = copy.copy(self)
+        engine.reached = reached
+        return engine
+
+    def apply_changes(self, changes) -> set:
+        """Apply changes as returned by read_delta_file to the dataset, updating its index
+        in place. Appending a flight that already exists, or updating or deleting one that
+        does not, is logged and skipped. Returns the codes of the airports the changed
+        flights depart from or arrive at"""
+        data = self.data
+        airports = set()
+        applied = 0
+        for op, flight_no, departure, flight in changes:
+            row = data.find(flight_no, departure)
+            if (row is None) == (op == "append"):
+                applied += 1
+                if row is not None:
+                    airports.add(data.airports[data.origin[row]])
+                    airports.add(data.airports[data.destination[row]])
+                if op == "append":
+                    row = data.append(*flight)
+                elif op == "update":
+                    data.update(row, *flight[1:])
+                else:
+                    data.delete(row)
+                airports.add(data.airports[data.origin[row]])
+                airports.add(data.airports[data.destination[row]])
+            else:
+                logger.info(
+                    "Skipping {} of flight {} departing at {} because it {}".format(
+                        op,
+                        flight_no,
+                        seconds_to_timestamp(departure),
+                        "already exists" if op == "append" else "does not exist",
+                    )
+                )
+        self.bags_masks.clear()
+        logger.info("Applied {} of {} changes".format(applied, len(changes)))
+        return airports
+
+    def bags_mask(self, bags):
+        """Mask of the rows of the flights that allow bags, or None if all of them do"""
+        if bags <= 0:
+            return None
+        mask = self.bags_masks.get(bags)
+        if mask is None:
+            mask = bytearray(allowed >= bags for allowed in self.data.bags_allowed)
+            self.bags_masks[bags] = mask
+        return mask
+
+    def allowing_bags(self, query, paths) -> list:
+        """The paths, or pairs of outbound and return paths of round trips, whose flights
+        all allow the bags of query"""
+        allowed = self.bags_mask(query.bags)
+        if allowed is None:
+            return list(paths)
+        if query.round:
+            return [
+                pair for pair in paths if all(allowed[row] for row in pair[0] + pair[1])
+            ]
+        return [path for path in paths if all(allowed[row] for row in path)]
+
+    def search(self, query) -> list:
+        """All combinations of flights matching query, sorted by price"""
+        paths = self.search_paths(query)
+        with phase(self.stats, "build_combinations"):
+            return self.build_combinations(query, paths)
+
+    def search_paths(self, query) -> list:
+        """Paths of all trips matching query sorted by price, or pairs of outbound and
+        return paths for round trips"""
+        if query.pareto or query.pareto_stops:
+            with phase(self.stats, "search"):
+                return self.pareto_paths(query)
+        if not query.round:
+            return self.find_paths(query, limit=query.limit)
+        paths_0 = self.find_paths(query)
+        paths_1 = self.find_paths(query, True)
+        with phase(self.stats, "round_trip_join"):
+            return self.build_round_trip_paths(query, paths_0, paths_1, query.limit)
+
+    def pareto_paths(self, query) -> list:
+        """Paths of the trips matching query on the Pareto frontier of price and travel
+        time, and also number of stops if query.pareto_stops, sorted by price.
+
+        Round trips join the frontiers of both ways, where an outbound trip arriving
+        earlier or a return trip departing later is also better, as it can be combined
+        with more trips of the other way. Round trips with the same price, travel time
+        and stops as one of the results can be left out."""
+        if not query.round:
+            paths = pareto_frontier(
+                self.find_pareto_paths(query),
+                lambda path: self.pareto_criteria(query, path),
+            )
+            return self.sort_paths(query, paths)[: query.limit]
+        data = self.data
+        paths_0 = pareto_frontier(
+            self.find_pareto_paths(query),
+            lambda path: self.pareto_criteria(query, path) + (data.arrival[path[-1]],),
+        )
+        paths_1 = pareto_frontier(
+            self.find_pareto_paths(query, True),
+            lambda path: self.pareto_criteria(query, path)
+            + (-data.departure[path[0]],),
+        )
+        pairs = pareto_frontier(
+            self.iter_round_trip_paths(
+                query, self.sort_paths(query, paths_0), self.sort_paths(query, paths_1)
+            ),
+            lambda pair: self.pareto_round_trip_criteria(query, pair),
+        )
+        return pairs[: query.limit]
+
+    def pareto_criteria(self, query, path) -> tuple:
+        """Values of path to minimise in pareto_paths"""
+        if query.pareto_stops:
+            return self.path_price(query, path), self.travel_time(path), len(path)
+        return self.path_price(query, path), self.travel_time(path)
+
+    def pareto_round_trip_criteria(self, query, pair) -> tuple:
+        """Values of a pair of outbound and return paths to minimise in pareto_paths"""
+        criteria = (
+            self.path_price(query, pair[0]) + self.path_price(query, pair[1]),
+            max(self.travel_time(pair[0]), self.travel_time(pair[1])),
+        )
+        if query.pareto_stops:
+            return criteria + (len(pair[0]) + len(pair[1]),)
+        return criteria
+
+    def find_pareto_paths(self, query, is_return=False) -> list:
+        """Paths of the trips of query from the origin to the destination, or the other
+        way around if is_return, that are not beaten by another trip arriving at the same
+        time.
+
+        Partial trips are expanded in order of arrival. One is dropped as soon as another
+        one arriving at the same airport at the same time is at least as cheap, departed
+        at least as late, took no more flights if they are limited and went through no
+        other airports, and is strictly better in price, departure or number of stops if
+        they count, as every trip it could lead to is beaten too. Partial trips that can
+        not stay within query.max_price are dropped too."""
+        data = self.data
+        origins, destinations = self.endpoints(query, is_return)
+        if not origins or not destinations:
+            return []
+        first, useful, bounds = self.starting_flights(
+            query, origins, destinations, is_return
+        )
+        stats = self.stats
+        if stats is not None:
+            stats.expand(0, len(first))
+        count_flights = query.pareto_stops or query.stops is not None
+        # Labels (price, trip departure, path, airports) by (airport, arrival)
+        labels = {}
+        queue = []
+        paths = []
+        pruned = 0
+
+        def dominates(label, other):
+            return (
+                label[0] <= other[0]
+                and label[1] >= other[1]
+                and (not count_flights or len(label[2]) <= len(other[2]))
+                and label[3] <= other[3]
+                and (
+                    label[0] < other[0]
+                    or label[1] > other[1]
+                    or (query.pareto_stops and len(label[2]) < len(other[2]))
+                )
+            )
+
+        def add(label):
+            nonlocal pruned
+            row = label[2][-1]
+            key = (data.destination[row], data.arrival[row])
+            if bounds is not None and label[0] + bounds[key[0]] > query.max_price:
+                pruned += 1
+                return
+            bucket = labels.get(key)
+            if bucket is None:
+                labels[key] = [label]
+                heapq.heappush(queue, (key[1], key[0]))
+            elif not any(dominates(other, label) for other in bucket):
+                kept = [other for other in bucket if not dominates(label, other)]
+                pruned += len(bucket) - len(kept)
+                bucket[:] = kept
+                bucket.append(label)
+            else:
+                pruned += 1
+
+        for row in first:
+            add(
+                (
+                    data.base_price[row] + data.bag_price[row] * query.bags,
+                    data.departure[row],
+                    (row,),
+                    frozenset((data.destination[row],)),
+                )
+            )
+        while queue:
+            arrival, airport = heapq.heappop(queue)
+            bucket = labels.pop((airport, arrival), None)
+            if bucket is None:
+                continue
+            if airport in destinations:
+                paths.extend(label[2] for label in bucket)
+                continue
+            candidates = data.departing_from(
+                airport,
+                arrival + query.min_layover_time * 3600,
+                arrival + query.max_layover_time * 3600,
+            )
+            if stats is not None:
+                for label in bucket:
+                    stats.expand(len(label[2]), len(candidates))
+            for row in candidates:
+                next_airport = data.destination[row]
+                if not useful[row] or (
+                    next_airport in origins and next_airport not in destinations
+                ):
+                    continue
+                price = data.base_price[row] + data.bag_price[row] * query.bags
+                for label_price, departure, path, airports in bucket:
+                    if (
+                        next_airport in airports
+                        or next_airport == data.origin[path[0]]
+                        or (query.stops is not None and len(path) > query.stops)
+                        or (
+                            query.trip_duration is not None
+                            and (data.arrival[row] - departure) / 3600
+                            > query.trip_duration
+                        )
+                    ):
+                        continue
+                    add(
+                        (
+                            label_price + price,
+                            departure,
+                            path + (row,),
+                            airports | {next_airport},
+                        )
+                    )
+        if stats is not None:
+            stats.count("pruned_branches", pruned)
+            stats.count("paths_emitted", len(paths))
+        return paths
+
+    def find_flights(self, query, is_return=False, limit=None) -> list:
+        """Find all possible combinations of flights from the origin to the destination of
+        query, or the other way around if is_return, sorted by price. If limit is given only
+        the limit cheapest ones are returned"""
+        return [
+            self.build_combination(query, path)
+            for path in self.find_paths(query, is_return, limit)
+        ]
+
+    def find_paths(self, query, is_return=False, limit=None) -> list:
+        """Paths of find_flights"""
+        with phase(self.stats, "search"):
+            if limit is not None:
+                return [
+                    path
+                    for _, path in self.iter_cheapest_paths(query, limit, is_return)
+                ]
+            paths = list(self.iter_paths(query, is_return))
+        with phase(self.stats, "sort"):
+            return self.sort_paths(query, paths)
+
+    def iter_flights(self, query, is_return=False):
+        """Generate all possible combinations of flights of query, in the order they are
+        found"""
+        for path in self.iter_paths(query, is_return):
+            yield self.build_combination(query, path)
+
+    def iter_paths(self, query, is_return=False):
+        """Paths of iter_flights"""
+        origins, destinations = self.endpoints(query, is_return)
+        if not origins or not destinations:
+            return
+        first, useful, bounds = self.starting_flights(
+            query, origins, destinations, is_return
+        )
+        if self.iterative:
+            yield from self.iterative_search(
+                query, first, destinations, origins - destinations, useful, bounds
+            )
+            return
+        yield from self.recursive_search(
+            query,
+            first,
+            destinations,
+            (),
+            origins - destinations,
+            useful,
+            bounds=bounds,
+        )
+
+    def iter_cheapest_flights(self, query, limit=None, is_return=False):
+        """Generate the combinations of flights of query from the cheapest to the most
+        expensive one, stopping after limit combinations"""
+        for _, path in self.iter_cheapest_paths(query, limit, is_return):
+            yield self.build_combination(query, path)
+
+    def iter_cheapest_paths(self, query, limit=None, is_return=False):
+        """Generate the prices and paths of iter_cheapest_flights.
+
+        Partial trips are expanded best-first from a priority queue on their accumulated
+        price, so no trip more expensive than the last path generated is explored. Partial
+        trips that can not stay within query.max_price are not queued. With a limit and
+        no max_price the flights are not pruned first, as that takes longer than the few
+        expansions the limit needs on large datasets"""
+        data = self.data
+        origins, destinations = self.endpoints(query, is_return)
+        if not origins or not destinations:
+            return
+        first, useful, bounds = self.starting_flights(
+            query,
+            origins,
+            destinations,
+            is_return,
+            prune=limit is None or query.max_price is not None,
+        )
+        stats = self.stats
+        if stats is not None:
+            stats.expand(0, len(first))
+        queue = [
+            (data.base_price[row] + data.bag_price[row] * query.bags, (row,))
+            for row in first
+        ]
+        if bounds is not None:
+            queue = [
+                (price, path)
+                for price, path in queue
+                if price + bounds[data.destination[path[0]]] <= query.max_price
+            ]
+        heapq.heapify(queue)
+        found = 0
+        pruned = 0
+        try:
+            while queue and (limit is None or found < limit):
+                price, path = heapq.heappop(queue)
+                row = path[-1]
+                travel_time = data.arrival[row] - data.departure[path[0]]
+                if (
+                    query.trip_duration is not None
+                    and travel_time / 3600 > query.trip_duration
+                ):
+                    pruned += 1
+                    continue
+                if data.destination[row] in destinations:
+                    found += 1
+                    yield price, path
+                    continue
+                if query.stops is not None and len(path) > query.stops:
+                    pruned += 1
+                    continue
+                if self.reached is not None:
+                    self.reached.add(data.airports[data.destination[row]])
+                visited = origins - destinations
+                visited.add(data.origin[path[0]])
+                visited.update(data.destination[flight] for flight in path)
+                candidates = data.departing_from(
+                    data.destination[row],
+                    data.arrival[row] + query.min_layover_time * 3600,
+                    data.arrival[row] + query.max_layover_time * 3600,
+                )
+                if stats is not None:
+                    stats.expand(len(path), len(candidates))
+                for next_row in candidates:
+                    next_price = price + (
+                        data.base_price[next_row]
+                        + data.bag_price[next_row] * query.bags
+                    )
+                    if (
+                        not useful[next_row]
+                        or data.destination[next_row] in visited
+                        or (
+                            bounds is not None
+                            and next_price + bounds[data.destination[next_row]]
+                            > query.max_price
+                        )
+                    ):
+                        pruned += 1
+                    else:
+                        heapq.heappush(queue, (next_price, path + (next_row,)))
+        finally:
+            if stats is not None:
+                stats.count("pruned_branches", pruned)
+                stats.count("paths_emitted", found)
+
+    def endpoints(self, query, is_return=False) -> tuple:
+        """Sets of ids of the airports the trip of query can start and end at, leaving out
+        the ones not in the dataset"""
+        airport_ids = self.data.airport_ids
+        origins, destinations = (
+            {airport_ids[code] for code in split_airports(codes) if code in airport_ids}
+            for codes in (query.origin, query.destination)
+        )
+        if is_return:
+            return destinations, origins
+        return origins, destinations
+
+    def starting_flights(
+        self, query, origins, destinations, is_return=False, prune=True
+    ) -> tuple:
+        """Rows of the first flights of the trips of query from origins to destinations
+        that can be part of one, the mask of useful_flights and, if query has a
+        max_price, the price_bounds of every airport. Without prune the mask only leaves
+        out the flights that do not allow the bags of query"""
+        with phase(self.stats, "first_flights"):
+            first = self.first_flights(query, origins, is_return)
+        with phase(self.stats, "pruning"):
+            if prune:
+                useful = self.useful_flights(query, origins, destinations, first)
+            else:
+                useful = self.bags_mask(query.bags)
+                if useful is None:
+                    useful = bytearray(b"\x01") * len(self.data)
+                # Like useful_flights, trips do not fly back to one of the origins
+                first = [
+                    row
+                    for row in first
+                    if self.data.destination[row] not in origins - destinations
+                ]
+                if self.reached is not None:
+                    self.reached.update(
+                        self.data.airports[airport] for airport in origins
+                    )
+            bounds = None
+            if query.max_price is not None:
+                bounds = self.price_bounds(query, destinations, useful)
+        if self.stats is not None:
+            self.stats.count(
+                "return_flights_pruned" if is_return else "flights_pruned",
+                len(useful) - useful.count(1),
+            )
+        return [row for row in first if useful[row]], useful, bounds
+
+    def first_flights(self, query, origins, is_return=False) -> list:
+        """Rows of the flights the trip of query can start with from any of origins, in
+        the order they were added as if they all departed from one airport, leaving out
+        the ones that do not allow the bags of query.
+
+        The ranges of query are compiled once into bounds of the departure, which slice
+        the flights of every airport in the index, and of the time of day, which is
+        checked on the departures of the flights left"""
+        data = self.data
+        allowed = self.bags_mask(query.bags)
+        outbound_ranges, return_ranges = parse_ranges(query)
+        earliest, latest, earliest_time, latest_time = compile_ranges(
+            outbound_ranges if not is_return else return_ranges
+        )
+        rows = sorted(
+            itertools.chain.from_iterable(
+                data.departing_from(origin, earliest, latest) for origin in origins
+            )
+        )
+        if allowed is not None:
+            rows = [row for row in rows if allowed[row]]
+        if earliest_time is not None or latest_time is not None:
+            earliest_time = 0 if earliest_time is None else earliest_time
+            latest_time = DAY_SECONDS if latest_time is None else latest_time
+            departures = data.departure
+            rows = [
+                row
+                for row in rows
+                if earliest_time <= departures[row] % DAY_SECONDS <= latest_time
+            ]
+        return rows
+
+    def useful_flights(self, query, origins, destinations, first) -> bytearray:
+        """Mark the rows of the flights that can be part of a trip of query from one of the
+        airports in origins to one of the airports in destinations starting with one of
+        the flights in first.
+
+        A forward pass over the flights in departure order keeps the ones that can be
+        taken after one of the first flights, with the least number of flights and the
+        latest trip departure up to each one, and stops once no flight kept can be
+        followed by a later one. A backward pass over those in arrival order
+        keeps the ones a destination can be reached from, with the least number of flights
+        and the earliest trip arrival from each one. Both passes respect the layover times,
+        so a flight is only marked if a trip through it can fit the stops and the trip
+        duration. Flights that do not allow the bags of query are never marked. Airports
+        flown to twice are left for the search to rule out."""
+        data = self.data
+        useful = bytearray(len(data))
+        if self.reached is not None:
+            self.reached.update(data.airports[airport] for airport in origins)
+        if not first:
+            return useful
+        if data.index_order is None:
+            data.build_index()
+        flight_origins, flight_destinations = data.origin, data.destination
+        departures, arrivals = data.departure, data.arrival
+        min_layover = query.min_layover_time * 3600
+        max_layover = query.max_layover_time * 3600
+        max_flights = math.inf if query.stops is None else query.stops + 1
+        trip_duration = math.inf if query.trip_duration is None else query.trip_duration
+
+        allowed = self.bags_mask(query.bags)
+        # Trips end at the first destination they reach, so an airport that is both an
+        # origin and a destination can be flown to like any other destination
+        is_origin = bytearray(len(data.airports))
+        for airport in origins - destinations:
+            is_origin[airport] = 1
+        is_destination = bytearray(len(data.airports))
+        for airport in destinations:
+            is_destination[airport] = 1
+        # Latest departure a flight can have and still be taken in a trip, which grows
+        # with the arrivals of the flights kept that can be followed by another one
+        horizon = max(departures[row] for row in first)
+        first = set(first)
+        forward = {}
+        # Per airport, sorted (arrival, flights, trip departure) of the flights into it
+        arriving = [[] for _ in data.airports]
+
+        def visit_forward(row):
+            nonlocal horizon
+            airport = flight_origins[row]
+            if row in first:
+                label = (1, departures[row])
+            elif is_origin[airport] or not arriving[airport]:
+                return False
+            else:
+                flights = trip_departure = None
+                times = arriving[airport]
+                for _, previous_flights, previous_departure in times[
+                    bisect_left(times, (departures[row] - max_layover,)) : bisect_right(
+                        times, (departures[row] - min_layover, math.inf)
+                    )
+                ]:
+                    if (
+                        previous_flights < max_flights
+                        and (arrivals[row] - previous_departure) / 3600 <= trip_duration
+                    ):
+                        if flights is None or previous_flights + 1 < flights:
+                            flights = previous_flights + 1
+                        if (
+                            trip_departure is None
+                            or previous_departure > trip_departure
+                        ):
+                            trip_departure = previous_departure
+                if flights is None:
+                    return False
+                label = (flights, trip_departure)
+            if (arrivals[row] - label[1]) / 3600 > trip_duration or forward.get(
+                row
+            ) == label:
+                return False
+            forward[row] = label
+            insort(arriving[flight_destinations[row]], (arrivals[row],) + label)
+            if label[0] < max_flights:
+                horizon = max(horizon, arrivals[row] + max_layover)
+            return True
+
+        start = min(departures[row] for row in first)
+        end = len(data)
+        if query.trip_duration is not None:
+            end = bisect_right(
+                data.index_order,
+                max(departures[row] for row in first)
+                + math.ceil(query.trip_duration * 3600),
+                key=departures.__getitem__,
+            )
+        candidates = (
+            row
+            for row in data.index_order[
+                bisect_left(data.index_order, start, key=departures.__getitem__) : end
+            ]
+            if not is_origin[flight_destinations[row]]
+            and (not is_destination[flight_origins[row]] or row in first)
+            and (allowed is None or allowed[row])
+        )
+        scan(
+            candidates,
+            departures.__getitem__,
+            visit_forward,
+            min_layover == 0,
+            lambda departure: departure > horizon,
+        )
+
+        backward = {}
+        # Per airport, sorted (departure, flights, trip arrival) of the flights out of it
+        departing = [[] for _ in data.airports]
+
+        def visit_backward(row):
+            airport = flight_destinations[row]
+            flights_before, trip_departure = forward[row]
+            if is_destination[airport]:
+                label = (1, arrivals[row])
+            elif not departing[airport]:
+                return False
+            else:
+                flights = trip_arrival = None
+                times = departing[airport]
+                for _, next_flights, next_arrival in times[
+                    bisect_left(times, (arrivals[row] + min_layover,)) : bisect_right(
+                        times, (arrivals[row] + max_layover, math.inf)
+                    )
+                ]:
+                    if (
+                        flights_before + next_flights <= max_flights
+                        and (next_arrival - trip_departure) / 3600 <= trip_duration
+                    ):
+                        if flights is None or next_flights + 1 < flights:
+                            flights = next_flights + 1
+                        if trip_arrival is None or next_arrival < trip_arrival:
+                            trip_arrival = next_arrival
+                if flights is None:
+                    return False
+                label = (flights, trip_arrival)
+            if backward.get(row) == label:
+                return False
+            backward[row] = label
+            useful[row] = 1
+            insort(departing[flight_origins[row]], (departures[row],) + label)
+            return True
+
+        scan(
+            sorted(
+                forward,
+                key=lambda row: (arrivals[row], departures[row]),
+                reverse=True,
+            ),
+            arrivals.__getitem__,
+            visit_backward,
+            min_layover == 0,
+        )
+        if self.reached is not None:
+            self.reached.update(
+                data.airports[airport]
+                for airport, times in enumerate(arriving)
+                if times
+            )
+        return useful
+
+    def price_bounds(self, query, destinations, useful) -> list:
+        """Cheapest price for the bags of query from every airport to one of destinations
+        with the flights marked in useful, inf if there is none.
+
+        It is found with Dijkstra's algorithm from the destinations backwards, ignoring
+        the times of the flights, so it is a lower bound of the price of the rest of any
+        trip from the airport."""
+        data = self.data
+        arriving = [[] for _ in data.airports]
+        # Few flights are usually marked, and find skips the others much faster
+        row = useful.find(1)
+        while row != -1:
+            arriving[data.destination[row]].append(row)
+            row = useful.find(1, row + 1)
+        bounds = [math.inf] * len(data.airports)
+        for airport in destinations:
+            bounds[airport] = 0
+        queue = [(0, airport) for airport in destinations]
+        while queue:
+            price, airport = heapq.heappop(queue)
+            if price > bounds[airport]:
+                continue
+            for row in arriving[airport]:
+                previous_price = price + (
+                    data.base_price[row] + data.bag_price[row] * query.bags
+                )
+                if previous_price < bounds[data.origin[row]]:
+                    bounds[data.origin[row]] = previous_price
+                    heapq.heappush(queue, (previous_price, data.origin[row]))
+        # The prices are added in another order than in the trips, so the bounds are
+        # lowered by a margin that covers the rounding
+        return [bound * (1 - 1e-9) for bound in bounds]
+
+    def recursive_search(
+        self,
+        query,
+        candidates,
+        destinations,
+        path,
+        visited,
+        useful,
+        trip_departure=None,
+        bounds=None,
+        price=0,
+    ):
+        """Recursive generator of the paths of all possible trips to one of the airports in
+        destinations.
+
+        candidates are the rows of the flights that can be taken from the current airport,
+        path the tuple of rows of the flights already taken, visited the set of airports
+        the trip has already been through, which can not be flown to again any more than
+        the airport it started from, useful the mask of useful_flights and trip_departure
+        the departure time of the first flight of the trip. With the price_bounds of
+        query.max_price in bounds, trips whose price so far, price, can not stay within it
+        are not expanded, and neither are partial trips with no stops or time left."""
+        data = self.data
+        stats = self.stats
+        if stats is not None:
+            stats.expand(len(path), len(candidates))
+        # Counted here and added to stats once the candidates are done, or the search is
+        # stopped
+        pruned = emitted = 0
+        try:
+            for row in candidates:
+                airport = data.destination[row]
+                departure = (
+                    data.departure[row] if trip_departure is None else trip_departure
+                )
+                if (
+                    airport in visited
+                    or not useful[row]
+                    or (path and airport == data.origin[path[0]])
+                    or (
+                        query.trip_duration is not None
+                        and (data.arrival[row] - departure) / 3600 > query.trip_duration
+                    )
+                ):
+                    pruned += 1
+                    continue
+                row_price = price
+                if bounds is not None:
+                    row_price += data.base_price[row] + data.bag_price[row] * query.bags
+                    if row_price + bounds[airport] > query.max_price:
+                        pruned += 1
+                        continue
+                if airport in destinations:
+                    emitted += 1
+                    yield path + (row,)
+                elif query.stops is None or len(path) < query.stops:
+                    visited.add(airport)
+                    yield from self.recursive_search(
+                        query,
+                        data.departing_from(
+                            airport,
+                            data.arrival[row] + query.min_layover_time * 3600,
+                            data.arrival[row] + query.max_layover_time * 3600,
+                        ),
+                        destinations,
+                        path + (row,),
+                        visited,
+                        useful,
+                        departure,
+                        bounds,
+                        row_price,
+                    )
+                    visited.remove(airport)
+                else:
+                    pruned += 1
+        finally:
+            if stats is not None:
+                stats.count("pruned_branches", pruned)
+                stats.count("paths_emitted", emitted)
+
+    def iterative_search(
+        self, query, candidates, destinations, origins, useful, bounds=None
+    ):
+        """Generate the same paths as recursive_search from origins, in the same order,
+        with an explicit stack instead of recursion.
+
+        The rows of the flights taken and the candidates left at every hop are kept in
+        lists allocated once for the longest possible trip, and the airports visited in a
+        flag per airport. Partial trips with no stops or time left, or that can not stay
+        within query.max_price with the price_bounds in bounds, are not expanded."""
+        data = self.data
+        min_layover = query.min_layover_time * 3600
+        max_layover = query.max_layover_time * 3600
+        max_flights = len(data.airports) if query.stops is None else query.stops + 1
+        path = [0] * max_flights
+        stack = [None] * max_flights
+        # Price of the flights before every hop
+        prices = [0] * (max_flights + 1)
+        visited = bytearray(len(data.airports))
+        for origin in origins:
+            visited[origin] = 1
+        stats = self.stats
+        if stats is not None:
+            stats.expand(0, len(candidates))
+        stack[0] = iter(candidates)
+        depth = 0
+        pruned = emitted = 0
+        try:
+            while depth >= 0:
+                row = next(stack[depth], None)
+                if row is None:
+                    depth -= 1
+                    if depth >= 0:
+                        visited[data.destination[path[depth]]] = 0
+                    continue
+                airport = data.destination[row]
+                if (
+                    visited[airport]
+                    or not useful[row]
+                    or (depth and airport == data.origin[path[0]])
+                    or (
+                        query.trip_duration is not None
+                        and (
+                            data.arrival[row]
+                            - data.departure[path[0] if depth else row]
+                        )
+                        / 3600
+                        > query.trip_duration
+                    )
+                ):
+                    pruned += 1
+                    continue
+                if bounds is not None:
+                    price = prices[depth] + (
+                        data.base_price[row] + data.bag_price[row] * query.bags
+                    )
+                    if price + bounds[airport] > query.max_price:
+                        pruned += 1
+                        continue
+                    prices[depth + 1] = price
+                path[depth] = row
+                if airport in destinations:
+                    emitted += 1
+                    yield tuple(path[: depth + 1])
+                elif depth + 1 < max_flights:
+                    visited[airport] = 1
+                    depth += 1
+                    candidates = data.departing_from(
+                        airport,
+                        data.arrival[row] + min_layover,
+                        data.arrival[row] + max_layover,
+                    )
+                    if stats is not None:
+                        stats.expand(depth, len(candidates))
+                    stack[depth] = iter(candidates)
+                else:
+                    pruned += 1
+        finally:
+            if stats is not None:
+                stats.count("pruned_branches", pruned)
+                stats.count("paths_emitted", emitted)
+
+    def path_price(self, query, path) -> float:
+        """Total price of the flights in path for the bags of query"""
+        data = self.data
+        return sum(
+            [data.base_price[row] + data.bag_price[row] * query.bags for row in path]
+        )
+
+    def travel_time(self, path) -> int:
+        """Seconds from the departure of the first flight of path to the arrival of the last"""
+        return self.data.arrival[path[-1]] - self.data.departure[path[0]]
+
+    def sort_paths(self, query, paths) -> list:
+        """Sort paths by price for the bags of query. Ties keep the order in which the
+        search finds the paths."""
+        return sorted(paths, key=lambda path: (self.path_price(query, path), path))
+
+    def sort_round_trip_paths(self, query, pairs) -> list:
+        """Sort pairs of outbound and return paths by the price of the round trip for the
+        bags of query. Ties are sorted by outbound and then by return path."""
+        return sorted(pairs, key=lambda pair: self.round_trip_sort_key(query, pair))
+
+    def round_trip_sort_key(self, query, pair) -> tuple:
+        """Key of a pair of outbound and return paths in sort_round_trip_paths"""
+        outbound_price = self.path_price(query, pair[0])
+        return_price = self.path_price(query, pair[1])
+        return (
+            outbound_price + return_price,
+            outbound_price,
+            pair[0],
+            return_price,
+            pair[1],
+        )
+
+    def build_combinations(self, query, paths) -> list:
+        """Build the json-compatible combinations of paths, the result of search_paths"""
+        return list(self.iter_combinations(query, paths))
+
+    def iter_combinations(self, query, paths):
+        """Generate the combinations of build_combinations one at a time"""
+        if query.round:
+            for outbound, inbound in paths:
+                yield self.build_round_trip_combination(query, outbound, inbound)
+        else:
+            for path in paths:
+                yield self.build_combination(query, path)
+
+    def build_combination(self, query, path) -> dict:
+        """Build the json-compatible combination of the flights in the rows of path. If
+        query is flexible it also has the departure_date of the trip"""
+        flights = [self.data.flight(row) for row in path]
+        combination = {
+            "flights": flights,
+            "bags_allowed": min([flight["bags_allowed"] for flight in flights]),
+            "bags_count": query.bags,
+            "destination": flights[-1]["destination"],
+            "origin": flights[0]["origin"],
+            "total_price": sum(
+                [
+                    flight["base_price"] + flight["bag_price"] * query.bags
+                    for flight in flights
+                ]
+            ),
+            "travel_time": str(timedelta(seconds=self.travel_time(path))),
+        }
+        if query.flexible:
+            combination["departure_date"] = flights[0]["departure"][:10]
+        return combination
+
+    def build_round_trip_combination(self, query, outbound, inbound) -> dict:
+        """Build the json-compatible combination of the round trip made of the outbound and
+        inbound paths"""
+        combination_0 = self.build_combination(query, outbound)
+        combination_1 = self.build_combination(query, inbound)
+        combination = {
+            "flights": combination_0["flights"] + combination_1["flights"],
+            "bags_allowed": min(
+                [combination_0["bags_allowed"], combination_1["bags_allowed"]]
+            ),
+            "bags_count": query.bags,
+            "destination": combination_0["destination"],
+            "origin": combination_0["origin"],
+            "total_price": combination_0["total_price"] + combination_1["total_price"],
+            "travel_time": str(
+                timedelta(
+                    seconds=max(self.travel_time(outbound), self.travel_time(inbound))
+                )
+            ),
+        }
+        if query.flexible:
+            combination["departure_date"] = combination_0["departure_date"]
+            combination["return_origin"] = combination_1["origin"]
+            combination["return_destination"] = combination_1["destination"]
+            combination["return_date"] = combination_1["departure_date"]
+        return combination
+
+    def build_round_trip_paths(self, query, paths_0, paths_1, limit=None) -> list:
+        """Build all possible round trips from the outbound paths_0 and the return paths_1,
+        both sorted with sort_paths, as pairs of paths sorted by price. If limit is given
+        only the limit cheapest ones are built"""
+        return list(
+            itertools.islice(self.iter_round_trip_paths(query, paths_0, paths_1), limit)
+        )
+
+    def iter_round_trip_paths(self, query, paths_0, paths_1):
+        """Generate the round trips of build_round_trip_paths from the cheapest to the most
+        expensive one, in the order of sort_round_trip_paths.
+
+        The return paths are sorted by departure, so the ones an outbound path can be
+        combined with are found with a binary search. Every outbound path then walks its
+        compatible return paths from the cheapest one, and a priority queue merges those
+        walks, so the pairs come out cheapest first without building all of them. Pairs
+        over the max_price of query are left out."""
+        data = self.data
+        min_layover = query.min_layover_time * 3600
+        prices_1 = [self.path_price(query, path) for path in paths_1]
+        departures_1 = [data.departure[path[0]] for path in paths_1]
+        by_departure = sorted(range(len(paths_1)), key=departures_1.__getitem__)
+        departures = [departures_1[j] for j in by_departure]
+
+        def departing_after(earliest):
+            return (
+                j for j, departure in enumerate(departures_1) if departure >= earliest
+            )
+
+        walks = []
+        queue = []
+        for i, path_0 in enumerate(paths_0):
+            earliest = data.arrival[path_0[-1]] + min_layover
+            start = bisect_left(departures, earliest)
+            compatible = len(paths_1) - start
+            if compatible == 0:
+                walks.append(None)
+                continue
+            # Few compatible paths are sorted, otherwise the incompatible ones are skipped
+            if compatible * 4 < len(paths_1):
+                walk = iter(sorted(by_departure[start:]))
+            else:
+                walk = departing_after(earliest)
+            walks.append(walk)
+            j = next(walk)
+            price_0 = self.path_price(query, path_0)
+            queue.append((price_0 + prices_1[j], i, j, price_0))
+        heapq.heapify(queue)
+        while queue:
+            price, i, j, price_0 = queue[0]
+            if query.max_price is not None and price > query.max_price:
+                return
+            yield paths_0[i], paths_1[j]
+            j = next(walks[i], None)
+            if j is None:
+                heapq.heappop(queue)
+            else:
+                heapq.heapreplace(queue, (price_0 + prices_1[j], i, j, price_0))
+
+
+def answer_query(engine, values) -> dict:
+    """Answer a query given as a dict for SearchQuery.from_dict plus an optional "id" with
+    a response dict with the id and either the "results" or an "error". engine can be a
+    FlightSearch or anything else with its search method"""
+    values = dict(values)
+    request_id = values.pop("id", None)
+    try:
+        query = SearchQuery.from_dict(values)
+    except ValueError as e:
+        return {"id": request_id, "error": str(e)}
+    try:
+        error = input_arguments_error(query)
+        if error is not None:
+            return {"id": request_id, "error": error}
+        return {"id": request_id, "results": engine.search(query)}
+    except Exception as e:
+        logger.exception("Query {} failed".format(request_id))
+        return {"id": request_id, "error": str(e)}
+
+
+def pareto_frontier(items, criteria) -> list:
+    """Items no other item beats, keeping their order. An item is beaten by another one
+    with no greater criteria and at least one smaller, so items with the same criteria
+    are all kept"""
+    items = list(items)
+    values = [criteria(item) for item in items]
+    frontier = []
+    beaten = [False] * len(items)
+    for i in sorted(range(len(items)), key=values.__getitem__):
+        for j in frontier:
+            if values[j] != values[i] and all(
+                value_j <= value_i for value_j, value_i in zip(values[j], values[i])
+            ):
+                beaten[i] = True
+                break
+        else:
+            frontier.append(i)
+    return [item for item, is_beaten in zip(items, beaten) if not is_beaten]
+
+
+def scan(rows, key, visit, repeat=False, until=None) -> None:
+    """Call visit on every row in order. If repeat, the rows with the same key are visited
+    again until visit returns False for all of them, as one of them can lead to another
+    when there is no minimum layover. If until is given the scan stops at the first row
+    whose key it returns True for, once all the rows with a smaller key are visited"""
+    if not repeat:
+        for row in rows:
+            if until is not None and until(key(row)):
+                return
+            visit(row)
+        return
+    for value, group in itertools.groupby(rows, key):
+        if until is not None and until(value):
+            return
+        group = list(group)
+        while any([visit(row) for row in group]) and len(group) > 1:
+            pass
@@ -0,0 +1,171 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import signal
+import sys
+from cache import QueryCache
+from concurrent.futures import ThreadPoolExecutor
+from search import FlightSearch, answer_query
+
+logging.basicConfig(encoding="utf-8", level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class QueryServer:
+    """Answer line-delimited json queries over one dataset loaded in memory.
+
+    Every request is a json object in one line with the long names of the command line
+    arguments of solution as keys, plus an optional "id" that is copied to the response,
+    e.g. {"id": 1, "origin": "WUE", "destination": "JBN", "bags": 1, "return": true}.
+    Every response is a json object in one line with the id and either the "results" or
+    an "error". Requests are answered concurrently, so responses can come out of order.
+    Results are cached, and the dataset reloaded when its csv file changes.
+
+    A request with a "delta" key applies the changes of that delta file to the dataset,
+    see read_delta_file, and is answered with the number of "changes" read and of cached
+    results "invalidated".
+    """
+
+    def __init__(self, engine, workers=None, cache_size=1024):
+        self.cache = QueryCache(engine, cache_size)
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    def answer(self, request) -> dict:
+        """Response to one request line"""
+        try:
+            values = json.loads(request)
+            if not isinstance(values, dict):
+                raise ValueError("The request must be a json object")
+        except ValueError as e:
+            return {"id": None, "error": str(e)}
+        if "delta" in values:
+            return self.apply_delta(values)
+        return answer_query(self.cache, values)
+
+    def apply_delta(self, values) -> dict:
+        """Response to a request to apply a delta file"""
+        request_id = values.get("id")
+        try:
+            changes, invalidated = self.cache.apply_delta_file(str(values["delta"]))
+        except (OSError, ValueError) as e:
+            return {"id": request_id, "error": str(e)}
+        return {"id": request_id, "changes": changes, "invalidated": invalidated}
+
+    async def serve(self, reader, write) -> None:
+        """Answer the request lines of reader until it is closed, passing every response
+        line to write as soon as it is ready"""
+        loop = asyncio.get_running_loop()
+        tasks = set()
+
+        async def handle(request):
+            response = await loop.run_in_executor(self.executor, self.answer, request)
+            await write((json.dumps(response) + "\n").encode())
+
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            if not line.strip():
+                continue
+            task = asyncio.create_task(handle(line.decode()))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.wait(tasks)
+
+    async def serve_stdio(self) -> None:
+        """Answer the requests read from stdin, writing the responses to stdout"""
+        loop = asyncio.get_running_loop()
+        reader = asyncio.StreamReader(limit=2**24)
+        await loop.connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(reader), sys.stdin
+        )
+
+        async def write(data):
+            sys.stdout.buffer.write(data)
+            sys.stdout.buffer.flush()
+
+        await self.serve(reader, write)
+
+    async def serve_unix_socket(self, path) -> None:
+        """Answer the requests of every client connecting to the unix socket in path"""
+
+        async def client(reader, writer):
+            async def write(data):
+                writer.write(data)
+                await writer.drain()
+
+            try:
+                await self.serve(reader, write)
+            finally:
+                writer.close()
+
+        server = await asyncio.start_unix_server(client, path, limit=2**24)
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, server.close)
+        logger.info("Listening on {}".format(path))
+        try:
+            async with server:
+                await server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def main(args):
+    """Main function. Load the csv files once and answer queries until stopped"""
+    server = QueryServer(
+        FlightSearch.from_csv(args.csv_file_path, args.binary_cache),
+        args.workers,
+        args.cache_size,
+    )
+    logger.info("Loaded {} flights".format(len(server.cache.engine.data)))
+    try:
+        if args.socket is not None:
+            asyncio.run(server.serve_unix_socket(args.socket))
+        else:
+            asyncio.run(server.serve_stdio())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Python weekend entry task query server. Reads line-delimited json "
+        "queries from stdin or a unix socket and answers them with the dataset loaded once."
+    )
+    parser.add_argument(
+        "csv_file_path",
+        help="Relative paths or globs of the csv dataset files, read at the same time and merged without duplicate flights",
+        type=str,
+        nargs="+",
+    )
+    parser.add_argument(
+        "-S",
+        "--socket",
+        help="Path of a unix socket to listen on instead of reading stdin.",
+        type=str,
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        help="Number of queries answered at the same time.",
+        type=int,
+    )
+    parser.add_argument(
+        "-c",
+        "--cache-size",
+        help="Maximum number of query results kept in memory, 0 to disable the cache.",
+        type=int,
+        default=1024,
+    )
+    parser.add_argument(
+        "-B",
+        "--binary-cache",
+        help="Load the dataset from a binary file next to the csv file, which is written again whenever the csv file changes.",
+        action="store_true",
+    )
+    main(parser.parse_args())
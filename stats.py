@@ -0,0 +1,80 @@
+import sys
+import time
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+class SearchStats:
+    """Phase times and counters of a run, filled in by the functions and engines it is
+    passed to.
+
+    phases holds the seconds spent in every phase, where load includes validation and
+    search includes first_flights and pruning. counters holds the number of rows loaded,
+    flights pruned before searching, with the ones of the return of round trips in
+    return_flights_pruned, partial trips expanded, paths emitted and branches pruned
+    during the search, rejected the rows rejected for every key of
+    REJECTION_REASONS and candidates_per_hop the candidate flights scanned at every hop
+    of the trips. files holds the seconds, rows loaded, rejected and dropped as duplicates
+    of every file when several are read. It is not thread-safe, so every thread should
+    have its own."""
+
+    def __init__(self):
+        self.phases = Counter()
+        self.counters = Counter()
+        self.rejected = Counter()
+        self.candidates_per_hop = []
+        self.files = {}
+
+    @contextmanager
+    def phase(self, name):
+        """Add the time spent in the with block to phase name"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] += time.perf_counter() - start
+
+    def count(self, name, value=1) -> None:
+        """Add value to counter name"""
+        self.counters[name] += value
+
+    def expand(self, hop, candidates) -> None:
+        """Count a partial trip with hop flights expanded with candidates flights"""
+        self.counters["nodes_expanded"] += 1
+        if hop >= len(self.candidates_per_hop):
+            self.candidates_per_hop.extend(
+                [0] * (hop + 1 - len(self.candidates_per_hop))
+            )
+        self.candidates_per_hop[hop] += candidates
+
+    def to_dict(self) -> dict:
+        """Json-compatible document with all the stats and the peak memory of the process"""
+        return {
+            "phases": dict(self.phases),
+            "counters": dict(self.counters),
+            "rows_rejected": dict(self.rejected),
+            "candidates_per_hop": list(self.candidates_per_hop),
+            "files": dict(self.files),
+            "peak_rss": peak_rss(),
+        }
+
+
+def phase(stats, name):
+    """stats.phase(name), or a context that does nothing if stats is None"""
+    if stats is None:
+        return nullcontext()
+    return stats.phase(name)
+
+
+def peak_rss():
+    """Peak resident memory of the process in bytes, or None where it is not available"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports it in kilobytes and macOS in bytes
+    return peak if sys.platform == "darwin" else peak * 1024